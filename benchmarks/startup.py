@@ -0,0 +1,65 @@
+"""
+    Startup time benchmark. Every entry point is imported in a fresh interpreter, several times, and the
+    median import time is reported together with the heavy dependencies that the import pulled in.
+
+    Run from the root of the repository:
+        python benchmarks/startup.py [--repeat N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules imported by the application and its headless entry points
+ENTRY_POINTS = ["src.gui", "src.parsepcb", "src.generatesteps", "src.watch", "src.jobserver"]
+
+# Dependencies that should only load when they are used
+HEAVY_MODULES = ["kivy", "cadquery", "ezdxf", "matplotlib"]
+
+# Cost of the dependencies themselves, i.e. what the lazy imports defer
+DEPENDENCIES = ["cadquery", "ezdxf", "ezdxf.addons.drawing.matplotlib"]
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def time_import(module, repeat):
+    samples = []
+    loaded = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-c", CHILD.format(module=module, heavy=HEAVY_MODULES)],
+                                cwd=REPOSITORY, capture_output=True, text=True)
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+        measurement = json.loads(result.stdout.strip().splitlines()[-1])
+        samples.append(measurement["seconds"])
+        loaded = measurement["loaded"]
+
+    return statistics.median(samples), ", ".join(loaded) or "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per module")
+    arguments = parser.parse_args()
+
+    print(f"{'module':<36}{'median import (s)':>18}   heavy modules loaded")
+    for module in ENTRY_POINTS + DEPENDENCIES:
+        seconds, loaded = time_import(module, arguments.repeat)
+        if seconds is None:
+            print(f"{module:<36}{'failed':>18}   {loaded}")
+        else:
+            print(f"{module:<36}{seconds:>18.3f}   {loaded}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then not measured
+    resource = None
+
+from src.geometry import LayerGeometry
+
+PLANE_OPTION = "Conductive Traces AND Vias AND Plane"
+
+# Features of a layer job, every feature contributes linearly to the predicted time and memory
+FEATURES = ("constant", "lines", "arcs", "polyline_segments", "hatch_vertices", "plane", "plane_holes",
+            "plane_lines")
+
+# Coefficients used until enough jobs were measured, rough figures from board.dxf
+DEFAULT_SECONDS = (0.5, 0.02, 0.01, 0.01, 0.002, 1.0, 0.002, 0.01)
+DEFAULT_MEMORY = (300e6, 50e3, 50e3, 50e3, 5e3, 50e6, 20e3, 50e3)
+
+# Only the most recent observations are kept, so the model follows upgrades of the machine and of OCC
+MAX_OBSERVATIONS = 500
+
+
+def layer_features(geometry, option, holes=None):
+    """
+        Feature vector of a layer job, ordered like FEATURES. Trace work grows with the number of
+        segments to fuse, and plane work grows with the holes to drill and the traces fused to the plane.
+        Planes are drilled with the holes of the whole board, so holes is the size of the drill map
+        (defaults to the circles of the layer itself).
+    """
+    plane = float(option == PLANE_OPTION)
+    if holes is None:
+        holes = len(geometry.circles)
+    return np.array([1.0, len(geometry.lines), len(geometry.arcs),
+                     len(geometry.polyline_vertices) + int(geometry.polyline_closed.sum()),
+                     len(geometry.hatch_vertices), plane, plane * holes, plane * len(geometry.lines)])
+
+
+def peak_memory():
+    """
+        Peak resident memory of the current process (bytes), or None where it cannot be measured
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def memory_budget(fraction=0.75):
+    """
+        Share of the physical memory of the machine (bytes) that jobs may use at the same time
+    """
+    try:
+        return fraction * os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return float("inf")
+
+
+class CostModel:
+    """
+        CostModel predicts the run time and peak memory of a layer job from the statistics of its geometry.
+        Both are linear in the FEATURES, with coefficients fitted by least squares on the jobs measured on
+        this machine. The measurements and coefficients are stored in a local JSON file.
+
+        Attributes
+        ----------
+        path : str
+            JSON file of the model. Created on the first save.
+
+        seconds_coefficients, memory_coefficients : numpy.ndarray
+            Coefficients of the FEATURES, DEFAULT_SECONDS and DEFAULT_MEMORY until calibrated
+
+        Methods
+        -------
+        predict()
+            Predicted seconds and peak memory (bytes) of a feature vector
+
+        record()
+            Store the measurements of a finished job and calibrate the model again
+
+        calibrate()
+            Fit the coefficients to the stored measurements
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.observations = []
+        self.seconds_coefficients = np.array(DEFAULT_SECONDS)
+        self.memory_coefficients = np.array(DEFAULT_MEMORY)
+
+        if os.path.exists(self.path):
+            with open(self.path) as model_file:
+                stored = json.load(model_file)
+            # Observations of another feature set cannot be reused
+            if stored.get("features") == list(FEATURES):
+                self.observations = stored["observations"]
+                self.calibrate()
+
+    def predict(self, features):
+        return max(float(features @ self.seconds_coefficients), 0.0), \
+               max(float(features @ self.memory_coefficients), 0.0)
+
+    def record(self, features, seconds, memory=None):
+        self.observations.append({"features": [float(value) for value in features], "seconds": seconds,
+                                  "memory": memory})
+        self.observations = self.observations[-MAX_OBSERVATIONS:]
+        self.calibrate()
+
+    def calibrate(self):
+        self.seconds_coefficients = fit_coefficients(
+            [(observation["features"], observation["seconds"]) for observation in self.observations],
+            DEFAULT_SECONDS)
+        self.memory_coefficients = fit_coefficients(
+            [(observation["features"], observation["memory"]) for observation in self.observations
+             if observation["memory"] is not None], DEFAULT_MEMORY)
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Write to a temporary file first, so that a crash never leaves a truncated model behind
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as model_file:
+            json.dump({"features": list(FEATURES), "observations": self.observations,
+                       "seconds_coefficients": self.seconds_coefficients.tolist(),
+                       "memory_coefficients": self.memory_coefficients.tolist()}, model_file)
+        os.replace(temporary_path, self.path)
+
+
+def fit_coefficients(samples, defaults):
+    """
+        Least squares fit of (features, value) samples. Features that never varied keep their default
+        coefficient, and negative coefficients are clipped, since no feature makes a job cheaper.
+    """
+    if len(samples) < len(defaults):
+        return np.array(defaults)
+
+    features = np.array([sample[0] for sample in samples])
+    values = np.array([sample[1] for sample in samples])
+
+    # Only fit the features that were seen, the constant feature is always seen
+    seen = np.flatnonzero(features.any(axis=0))
+    coefficients = np.array(defaults, dtype=np.float64)
+    coefficients[seen] = np.clip(np.linalg.lstsq(features[:, seen], values, rcond=None)[0], 0, None)
+    return coefficients
+
+
+def next_job(queued, running_memory, budget):
+    """
+        Choose the job to start among queued (job, predicted seconds, predicted memory) tuples. The longest
+        job is started first, so that long jobs do not start last and leave the other workers idle. When it
+        does not fit next to the running jobs, no shorter job is started either: the memory they release is
+        reserved for it, instead of being taken by a stream of small jobs. A job larger than the whole budget
+        is only started alone. Returns None if no job can be started now.
+    """
+    if not queued:
+        return None
+    job, _, memory = max(queued, key=lambda queued_job: queued_job[1])
+    if running_memory + memory <= budget or running_memory == 0:
+        return job
+    return None
+
+
+class TestCostModel(unittest.TestCase):
+
+    def test_calibration_recovers_linear_costs(self):
+        path = os.path.join(tempfile.mkdtemp(), "cost_model.json")
+        model = CostModel(path)
+        rng = np.random.default_rng(0)
+
+        true_seconds = np.array([2.0, 0.05, 0.0, 0.01, 0.001, 3.0, 0.01, 0.02])
+        for _ in range(40):
+            geometry = LayerGeometry(lines=rng.uniform(0, 1, (rng.integers(1, 300), 4)),
+                                     circles=rng.uniform(0, 1, (rng.integers(0, 100), 3)),
+                                     arcs=[(0, 0, 1, 0, 90)] * int(rng.integers(0, 50)))
+            features = layer_features(geometry, PLANE_OPTION if rng.random() < 0.5 else "Conductive Traces only")
+            model.record(features, float(features @ true_seconds), float(features @ true_seconds) * 1e6)
+        model.save()
+
+        # The calibration is restored from the file
+        features = layer_features(LayerGeometry(lines=np.zeros((100, 4)), circles=np.zeros((10, 3))), PLANE_OPTION)
+        seconds, memory = CostModel(path).predict(features)
+        self.assertAlmostEqual(seconds, float(features @ true_seconds), places=6)
+        self.assertAlmostEqual(memory / 1e6, seconds, places=4)
+
+    def test_plane_holes_come_from_the_drill_map(self):
+        geometry = LayerGeometry(lines=np.zeros((3, 4)))
+
+        self.assertEqual(layer_features(geometry, PLANE_OPTION, holes=40)[FEATURES.index("plane_holes")], 40)
+        self.assertEqual(layer_features(geometry, "Conductive Traces only", holes=40)[FEATURES.index("plane_holes")], 0)
+
+    def test_longest_job_is_started_first(self):
+        queued = [("small", 1, 1), ("large", 100, 8), ("medium", 10, 2)]
+
+        self.assertEqual(next_job(queued, 0, 10), "large")
+        self.assertEqual(next_job(queued, 2, 10), "large")
+        # Shorter jobs wait until the longest one fits, so it is not starved
+        self.assertIsNone(next_job(queued, 5, 10))
+        self.assertEqual(next_job(queued[:1] + queued[2:], 5, 10), "medium")
+        self.assertIsNone(next_job(queued, 10, 10))
+        self.assertIsNone(next_job([], 0, 10))
+        # A job larger than the budget still runs once nothing else is running
+        self.assertEqual(next_job([("huge", 1, 50)], 0, 10), "huge")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+import numpy as np
+
+from src.geometry import LayerGeometry, deduplicate_geometry
+
+# Layer option of layers that only contribute holes to the drill map, and are not generated themselves
+DRILL_ONLY = "Drill holes only"
+
+
+class DrillMap:
+    """
+        DrillMap holds the holes (vias and drilled pads) of a whole board. Holes go through the entire
+        stack, so they are collected once from the drill layers, or from all the selected layers when
+        none is designated, and shared by every plane layer instead of being looked up per layer.
+
+        Attributes
+        ----------
+        holes : numpy.ndarray
+            (N, 3) array of x, y, radius. Holes repeated on several layers are stored once, radii within
+            tolerance are merged, and the rows are sorted, so equal maps have equal arrays.
+
+        geometry : LayerGeometry
+            The holes as the circles of a layer. Its spatial index answers query_rect().
+
+        Methods
+        -------
+        from_layers()
+            Collect the circles of the given layers of a layer to geometry mapping
+
+        on_board()
+            The holes whose center lies inside the board
+
+        radius_to_holes()
+            Group the hole centers by radius, so that one drill primitive can be placed at all of them
+
+        query_rect()
+            Holes that intersect a rectangle, e.g. the vias under a filled area
+
+        save(), load()
+            Store the map in a .npy file, e.g. to hand it to a worker process
+    """
+
+    def __init__(self, holes=None):
+        holes = np.asarray(holes if holes is not None else np.empty((0, 3)), dtype=np.float64).reshape(-1, 3)
+        holes = deduplicate_geometry(LayerGeometry(circles=holes)).circles
+        self.holes = holes[np.lexsort(holes.T[::-1])] if len(holes) else holes
+        self.geometry = LayerGeometry(circles=self.holes)
+
+    @classmethod
+    def from_layers(cls, layer_to_geometry, layers=None):
+        if layers is None:
+            layers = layer_to_geometry.keys()
+        return cls(np.concatenate([np.empty((0, 3))] + [layer_to_geometry[layer].circles for layer in layers
+                                                        if layer in layer_to_geometry]))
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path))
+
+    def save(self, path):
+        np.save(path, self.holes)
+
+    def __len__(self):
+        return len(self.holes)
+
+    def __eq__(self, other):
+        return isinstance(other, DrillMap) and np.array_equal(self.holes, other.holes)
+
+    def on_board(self, width, height):
+        x, y = self.holes[:, 0], self.holes[:, 1]
+        return DrillMap(self.holes[(0 < x) & (x < width) & (0 < y) & (y < height)])
+
+    def radius_to_holes(self):
+        # Radii within tolerance were already merged into a single value
+        radii = self.holes[:, 2]
+        return {float(radius): self.holes[radii == radius, :2] for radius in np.unique(radii)}
+
+    def query_rect(self, x_min, y_min, x_max, y_max):
+        return self.holes[self.geometry.get_index().circles.query_rect(x_min, y_min, x_max, y_max)]
+
+
+class TestDrillMap(unittest.TestCase):
+
+    def test_holes_of_all_layers_are_merged(self):
+        via = [(0.5, 0.5, 0.02)]
+        layer_to_geometry = {"TOP": LayerGeometry(circles=via + [(0.2, 0.3, 0.01)]),
+                             "BOTTOM": LayerGeometry(circles=[(0.5, 0.5, 0.0200000001), (2.0, 0.5, 0.01)]),
+                             "DRILL": LayerGeometry(circles=via)}
+
+        drill_map = DrillMap.from_layers(layer_to_geometry)
+        self.assertEqual(len(drill_map), 3)
+        self.assertEqual(drill_map, DrillMap.from_layers(dict(reversed(layer_to_geometry.items()))))
+        self.assertEqual(len(DrillMap.from_layers(layer_to_geometry, ["DRILL"])), 1)
+
+        on_board = drill_map.on_board(1, 1)
+        self.assertEqual(len(on_board), 2)
+        self.assertEqual(sorted(on_board.radius_to_holes()), [0.01, 0.02])
+        np.testing.assert_array_equal(on_board.query_rect(0.45, 0.45, 0.55, 0.55), [via[0]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,17 +1,73 @@
 import math
 import os
 import shutil
+import tempfile
+import unittest
 
-import cadquery as cq
+import numpy as np
 
+from src.drillmap import DRILL_ONLY, DrillMap
+from src.geometry import DEFAULT_ANGLE_TOLERANCE, DEFAULT_TOLERANCE, LayerGeometry, as_layer_geometry, \
+    bulge_midpoints, deduplicate_geometry, quantize
+from src.lazy import LazyModule
 from src.parsepcb import ParsePCB
 
+# CadQuery loads OCC, which takes most of the startup time, so it is imported when the first solid is built
+cq = LazyModule("cadquery")
+assembly_exporters = LazyModule("cadquery.occ_impl.exporters.assembly")
 
-def create_output_directory():
-    directory = 'STEP_files'
-    if os.path.exists(directory):
+
+def create_output_directory(clean=True, directory='STEP_files'):
+    if clean and os.path.exists(directory):
         shutil.rmtree(directory)
-    os.makedirs(directory)
+    os.makedirs(directory, exist_ok=True)
+
+
+def step_file_name(layer):
+    return f"STEP_files/{layer.lower()}.step"
+
+
+def fuse_all(shapes):
+    """
+        Fuse shapes pairwise in a balanced tree. A single multi-argument fuse is faster, but returns
+        invalid solids when many of the tools overlap each other, as rounded trace corners do.
+    """
+    while len(shapes) > 1:
+        shapes = [shapes[i].fuse(shapes[i + 1]).clean() if i + 1 < len(shapes) else shapes[i]
+                  for i in range(0, len(shapes), 2)]
+
+    return shapes[0]
+
+
+def union_or_compound(base, other):
+    """
+        Union two workplanes. Solids that OCC cannot fuse into a valid solid, e.g. trace outlines that only
+        graze each other, are kept as separate solids of the result so the layer is still written. The
+        separate solids are fused one at a time, and never as a compound: a boolean against a compound of
+        overlapping solids (e.g. the plane against traces that did not fuse) can run for hours.
+    """
+    if not isinstance(other, cq.Workplane):
+        other = cq.Workplane("XY").add(other)
+    # Nothing to fuse, e.g. a plane layer without traces
+    if not other.vals():
+        return base
+    if not base.vals():
+        return other
+
+    fused, *separate = base.vals()
+    for piece in other.vals():
+        try:
+            candidate = fused.fuse(piece).clean()
+            if candidate.isValid():
+                fused = candidate
+                continue
+        except ValueError:
+            pass
+
+        print("Could not fuse into a valid solid, keeping a separate solid instead")
+        separate.append(piece)
+
+    return cq.Workplane("XY").add([fused] + separate)
 
 
 class GenerateSteps:
@@ -22,7 +78,8 @@ class GenerateSteps:
             Attributes
             ----------
             layer_to_entities : dict
-                Maps layers to their entities. Uses layers as keys, and entity list of a given layer as value for a key
+                Maps layers to their entities. Uses layers as keys, and entity list of a given layer as value for a key.
+                A LayerGeometry (see ParsePCB.get_layer_geometry()) can be given instead of the entity list.
 
             pcb_height: float
                 Height of the PCB (inches)
@@ -40,24 +97,84 @@ class GenerateSteps:
                 Dimensions of conductive traces (inches)
                 TODO: determine default value
 
+            instanced: bool
+                Write each layer as a STEP assembly, where repeated features (vias of a given radius,
+                arcs of a given shape) are built once and referenced through placement transforms
+
+            panel_rows, panel_columns: int
+                Number of copies of the board along Y and X. Panelized layers are written as a STEP
+                assembly that references the board solid once per copy.
+
+            panel_pitch: tuple (x, y)
+                Distance between the origins of neighbouring boards in the panel (inches).
+                Defaults to the PCB width and height.
+
+            keep_workplanes: bool
+                Keep the solids of every layer in layer_to_workplane after they are written. When False,
+                each layer is written as soon as it is built and its solids are released.
+
+            drill_map: DrillMap
+                Holes drilled through every plane layer. By default they are collected from the layers set to
+                "Drill holes only", or from all the selected layers if there are none. Drill layers are not
+                generated themselves. Callers that only generate some of the layers (watch mode, the job
+                server) pass the map of the whole board.
+
+            clean_output: bool
+                Empty the STEP_files directory before writing. Watch mode regenerates only the layers that
+                changed and turns this off, so the STEP files of the other layers are kept.
+
+            layer_finished: callable
+                Called with the name of every layer once it is finished, i.e. its STEP file is written, or the
+                layer has no solids to write. Used to report progress to a supervising process.
+
             Methods
             -------
             __init__()
                 Process attributes and initialize the WorkPlanes for each layer
 
+            extract_geometry()
+                Convert the entities of each layer to NumPy arrays and remove duplicate primitives,
+                since every duplicate would otherwise cost its own OCC boolean
+
+            drilled_plane()
+                Board plane with the holes of the drill map cut out. It is built once per layer thickness
+                and shared by all plane layers, which only add their own traces to it.
+
+            add_arcs()
+                Extrude arcs as annular sector solids. Each distinct arc shape is built once and
+                placed by transform, see arc_primitive()
+
+            add_polylines()
+                Extrude each polyline as a single trace outline, built by offsetting its path (including
+                bulged segments) by half of its width
+
+            add_hatches()
+                Extrude each filled polygon as a single face with holes, drilled by the layer's vias in plane mode
+
+            build_layer_assembly()
+                Instanced output: assemble the plane, the fused line traces, and references to the
+                cached arc solids of a layer without fusing them
+
+            panelize()
+                Reference a layer's solid or assembly once per board of the panel
+
 
             """
 
     def __init__(self, selected_layer_to_entities, selected_layer_to_options, pcb_width, pcb_height, layer_thickness,
-                 conductive_trace_width, conductive_trace_thickness):
+                 conductive_trace_width, conductive_trace_thickness, instanced=False, panel_rows=1, panel_columns=1,
+                 panel_pitch=None, clean_output=True, keep_workplanes=True, drill_map=None, layer_finished=None):
         print("~~~ Generating STEP files ~~~")
         print("-----------------------------\n")
         # Get the dictionary that maps layers to their entities
         self.selected_layer_to_entities = selected_layer_to_entities
-        self.selected_layers = self.selected_layer_to_entities.keys()
-
         self.selected_layer_to_options = selected_layer_to_options
 
+        # Drill layers only contribute holes
+        drill_layers = [layer for layer in self.selected_layer_to_entities
+                        if self.selected_layer_to_options[layer] == DRILL_ONLY]
+        self.selected_layers = [layer for layer in self.selected_layer_to_entities if layer not in drill_layers]
+
         # Store dimensions (width x height x thickness)
         self.layer_dimensions = [pcb_width, pcb_height, layer_thickness]
 
@@ -65,13 +182,44 @@ class GenerateSteps:
 
         self.supported_dxf_entity_types = ['LINE', 'CIRCLE', 'ARC']
 
-        # Dictionary to layers to their WorkPlane
+        # Output mode
+        self.instanced = instanced
+        self.panel = (panel_rows, panel_columns)
+        self.panel_pitch = panel_pitch if panel_pitch is not None else (pcb_width, pcb_height)
+
+        # Dictionary to layers to their WorkPlane, or to their Assembly in instanced mode
         self.layer_to_workplane = {}
 
-        create_output_directory()
+        # Dictionary of layers to their deduplicated geometry arrays
+        self.selected_layer_to_geometry = {}
+
+        # Dictionary of (radius, sweep, width, thickness) keys to the arc solid built at the origin
+        self.arc_primitive_cache = {}
+
+        # Dictionary of (radius, thickness) keys to the cylinder used to drill holes of that radius
+        self.hole_primitive_cache = {}
+
+        # Dictionary of thickness keys to the drilled plane of that thickness
+        self.plane_cache = {}
+
+        self.layer_finished = layer_finished
+
+        create_output_directory(clean_output)
         # call the methods
-        self.generate_STEP_workplanes()
-        self.render_STEPs()
+        self.extract_geometry()
+        if drill_map is None:
+            drill_map = DrillMap.from_layers(self.selected_layer_to_geometry, drill_layers or None)
+        self.drill_map = drill_map.on_board(pcb_width, pcb_height)
+        if keep_workplanes:
+            self.generate_STEP_workplanes()
+            self.render_STEPs()
+        else:
+            # Write every layer as soon as it is built and release its solids, so that only one layer's
+            # solids are in memory at a time
+            for selected_layer in self.selected_layers:
+                self.generate_STEP_workplanes([selected_layer])
+                self.render_STEPs()
+                del self.layer_to_workplane[selected_layer]
         # TODO: call method to add lines
 
     # Render the STEP files
@@ -79,121 +227,493 @@ class GenerateSteps:
         for selected_layer, workplane in self.layer_to_workplane.items():
             if workplane:
                 print(f"Rendering {selected_layer.lower()}.step")
-                cq.exporters.export(workplane, f"STEP_files/{selected_layer.lower()}.step")
-
-    def generate_STEP_workplanes(self):
-        for selected_layer in self.selected_layers:
-            if self.selected_layer_to_options[selected_layer] == "Conductive Traces only":
+                if self.panel != (1, 1):
+                    workplane = self.panelize(selected_layer, workplane)
+
+                if isinstance(workplane, cq.Assembly):
+                    assembly_exporters.exportAssembly(workplane, step_file_name(selected_layer))
+                else:
+                    cq.exporters.export(workplane, step_file_name(selected_layer))
+            if self.layer_finished is not None:
+                self.layer_finished(selected_layer)
+
+    def panelize(self, selected_layer, part):
+        """
+            Build a panel assembly that references the same board solid (or layer assembly) once per copy,
+            so that the size of the STEP file does not grow with the number of boards
+        """
+        rows, columns = self.panel
+        panel = cq.Assembly(name=f"{selected_layer.lower()}_panel")
+        for row in range(rows):
+            for column in range(columns):
+                panel.add(part, name=f"{selected_layer.lower()}_r{row}_c{column}",
+                          loc=cq.Location(cq.Vector(column * self.panel_pitch[0], row * self.panel_pitch[1], 0)))
+
+        return panel
+
+    def extract_geometry(self):
+        for selected_layer in self.selected_layer_to_entities:
+            geometry = as_layer_geometry(self.selected_layer_to_entities[selected_layer])
+            deduplicated = deduplicate_geometry(geometry)
+            if deduplicated.count() < geometry.count():
+                print(f"Removed {geometry.count() - deduplicated.count()} duplicate entities from {selected_layer}")
+            self.selected_layer_to_geometry[selected_layer] = deduplicated
+
+    def generate_STEP_workplanes(self, selected_layers=None):
+        for selected_layer in selected_layers if selected_layers is not None else self.selected_layers:
+            if self.instanced:
+                extrude_from_layer = \
+                    self.selected_layer_to_options[selected_layer] == "Conductive Traces AND Vias AND Plane"
+                self.layer_to_workplane[selected_layer] = self.build_layer_assembly(
+                    selected_layer, self.selected_layer_to_geometry[selected_layer], extrude_from_layer)
+
+            elif self.selected_layer_to_options[selected_layer] == "Conductive Traces only":
                 self.layer_to_workplane[selected_layer] = self.add_lines(selected_layer,
-                                                                         self.selected_layer_to_entities[
+                                                                         self.selected_layer_to_geometry[
                                                                              selected_layer], False)
 
             elif self.selected_layer_to_options[selected_layer] == "Conductive Traces AND Vias AND Plane":
-                r = self.add_holes(selected_layer, self.selected_layer_to_entities[selected_layer])
-                traces = self.add_lines(selected_layer, self.selected_layer_to_entities[selected_layer], True)
-                self.layer_to_workplane[selected_layer] = r.union(traces)
-
-    def add_holes(self, selected_layer, selected_layer_entities):
-
-        print(f"Processing {selected_layer}'s circles and arcs")
-
-        # Dictionary that maps radii to the holes of that radius
-        radius_to_holes = {}
-
-        for entity in selected_layer_entities:
-            seen_radii = list(radius_to_holes.keys())
-            if entity.dxftype() in self.supported_dxf_entity_types and entity.dxftype() != 'LINE':
-                if 0 < entity.dxf.center[0] < self.layer_dimensions[0] and 0 < entity.dxf.center[1] < \
-                        self.layer_dimensions[1]:
-                    if entity.dxf.radius not in seen_radii:
-                        radius_to_holes[entity.dxf.radius] = []
-                    radius_to_holes[entity.dxf.radius].append((round(
-                        entity.dxf.center[0] - self.layer_dimensions[0] / 2, 4), round(
-                        entity.dxf.center[1] - self.layer_dimensions[1] / 2, 4)))
-
-        r = cq.Workplane("XY").box(self.layer_dimensions[0], self.layer_dimensions[1], self.layer_dimensions[2])
-        r = r.faces(">Z").workplane()
-        i = 0
-        last_point = (0, 0)
-        for radius, holes in radius_to_holes.items():
-            for hole in holes:
-                r = r.center(hole[0] - last_point[0], hole[1] - last_point[1])
-                r = r.circle(radius)
-                r = r.cutThruAll()
-
-                last_point = hole
-                i += 1
+                r = self.drilled_plane(self.layer_dimensions[2])
+                traces = self.add_lines(selected_layer, self.selected_layer_to_geometry[selected_layer], True)
+                self.layer_to_workplane[selected_layer] = union_or_compound(r, traces)
+
+    def build_layer_assembly(self, selected_layer, selected_layer_geometry, extrude_from_layer):
+        assembly = cq.Assembly(name=selected_layer.lower())
+
+        if extrude_from_layer:
+            assembly.add(self.drilled_plane(self.layer_dimensions[2]), name="plane")
+
+        traces = self.add_lines(selected_layer, selected_layer_geometry, extrude_from_layer, include_arcs=False)
+        if traces.solids().size():
+            assembly.add(traces, name="traces")
+
+        # Every arc references its cached solid instead of being fused into the traces
+        for i, (arc, location) in enumerate(self.place_arcs(selected_layer, selected_layer_geometry,
+                                                             self.trace_thickness(extrude_from_layer))):
+            assembly.add(arc, loc=location, name=f"arc_{i}")
+
+        return assembly
 
+    def trace_thickness(self, extrude_from_layer):
+        if extrude_from_layer:
+            # Increment trace thickness by layer thickness
+            return self.trace_dimensions[1] + self.layer_dimensions[2]
+        return self.trace_dimensions[1]
+
+    def drilled_plane(self, thickness):
+        key = int(quantize(thickness, DEFAULT_TOLERANCE))
+        if key in self.plane_cache:
+            return self.plane_cache[key]
+
+        print(f"Drilling {len(self.drill_map)} holes in the plane")
+
+        r = cq.Workplane("XY").box(self.layer_dimensions[0], self.layer_dimensions[1], thickness)
+
+        # Place one cached cylinder per radius at every hole, and drill them all in a single cut
+        offset = np.array([self.layer_dimensions[0] / 2, self.layer_dimensions[1] / 2])
+        drills = []
+        for radius, holes in self.drill_map.radius_to_holes().items():
+            drill = self.hole_primitive(radius, thickness)
+            drills.extend(drill.moved(cq.Location(cq.Vector(x, y, 0))) for x, y in np.round(holes - offset, 4))
+
+        if drills:
+            r = cq.Workplane("XY").add(r.val().cut(*drills))
+
+        self.plane_cache[key] = r
         return r
 
+    def hole_primitive(self, radius, thickness):
+        key = (int(quantize(radius, DEFAULT_TOLERANCE)), int(quantize(thickness, DEFAULT_TOLERANCE)))
+        if key not in self.hole_primitive_cache:
+            # Cylinder running through the whole plane, which is centered on Z = 0
+            self.hole_primitive_cache[key] = cq.Solid.makeCylinder(radius, 2 * thickness, cq.Vector(0, 0, -thickness))
+
+        return self.hole_primitive_cache[key]
+
     # TODO: Work in progress
-    def add_lines(self, selected_layer, selected_layer_entities, extrude_from_layer):
+    def add_lines(self, selected_layer, selected_layer_geometry, extrude_from_layer, include_arcs=True):
         print(f"Processing {selected_layer}'s lines")
 
-        if extrude_from_layer:
-            # Increment trace thickness by layer thickness
-            trace_thickness = self.trace_dimensions[1] + self.layer_dimensions[2]
-        else:
-            trace_thickness = self.trace_dimensions[1]
+        trace_thickness = self.trace_thickness(extrude_from_layer)
 
         compatible_lines = []
         base = cq.Workplane("XY")
 
-        for entity in selected_layer_entities:
-            if entity.dxftype() == 'LINE':
-                line = [(entity.dxf.start[0], entity.dxf.start[1]), (entity.dxf.end[0], entity.dxf.end[1])]
-                (x_start, y_start), (x_end, y_end) = line
-
-                if x_start == x_end:
-                    (leX_start, leY_start) = (x_start + self.trace_dimensions[0] ** (6 / 11), y_start)
-                    (reX_start, reY_start) = (x_start - self.trace_dimensions[0] ** (6 / 11), y_start)
-
-                    (leX_end, leY_end) = (x_end + self.trace_dimensions[0] ** (6 / 11), y_end)
-                    (reX_end, reY_end) = (x_end - self.trace_dimensions[0] ** (6 / 11), y_end)
-
-                elif y_start == y_end:
-                    (leX_start, leY_start) = (x_start, y_start - self.trace_dimensions[0] ** (6 / 11))
-                    (reX_start, reY_start) = (x_start, y_start + self.trace_dimensions[0] ** (6 / 11))
-
-                    (leX_end, leY_end) = (x_end, y_end - self.trace_dimensions[0] ** (6 / 11))
-                    (reX_end, reY_end) = (x_end, y_end + self.trace_dimensions[0] ** (6 / 11))
-
-                elif ((x_start < x_end) and (y_start < y_end)) or ((x_start > x_end) and (y_start > y_end)):
-                    (leX_start, leY_start) = (
-                        x_start - (math.sqrt(self.trace_dimensions[0]) / 2),
-                        y_start + (math.sqrt(self.trace_dimensions[0]) / 2))
-                    (reX_start, reY_start) = (
-                        x_start + (math.sqrt(self.trace_dimensions[0]) / 2),
-                        y_start - (math.sqrt(self.trace_dimensions[0]) / 2))
-
-                    (leX_end, leY_end) = (x_end - (math.sqrt(self.trace_dimensions[0]) / 2),
-                                          y_end + (math.sqrt(self.trace_dimensions[0]) / 2))
-                    (reX_end, reY_end) = (x_end + (math.sqrt(self.trace_dimensions[0]) / 2),
-                                          y_end - (math.sqrt(self.trace_dimensions[0]) / 2))
-
-                elif ((x_start < x_end) and (y_start > y_end)) or ((x_start > x_end) and (y_start < y_end)):
-                    (leX_start, leY_start) = (
-                        x_start - (math.sqrt(self.trace_dimensions[0]) / 2),
-                        y_start - (math.sqrt(self.trace_dimensions[0]) / 2))
-                    (reX_start, reY_start) = (
-                        x_start + (math.sqrt(self.trace_dimensions[0]) / 2),
-                        y_start + (math.sqrt(self.trace_dimensions[0]) / 2))
-
-                    (leX_end, leY_end) = (x_end - (math.sqrt(self.trace_dimensions[0]) / 2),
-                                          y_end - (math.sqrt(self.trace_dimensions[0]) / 2))
-                    (reX_end, reY_end) = (x_end + (math.sqrt(self.trace_dimensions[0]) / 2),
-                                          y_end + (math.sqrt(self.trace_dimensions[0]) / 2))
-
-                conductive_trace = (cq.Workplane("XY").moveTo(leX_start - self.layer_dimensions[0] / 2,
-                                                              leY_start - self.layer_dimensions[1] / 2).
-                                    lineTo(leX_end - self.layer_dimensions[0] / 2,
-                                           leY_end - self.layer_dimensions[1] / 2).lineTo(
-                    reX_end - self.layer_dimensions[0] / 2, reY_end - self.layer_dimensions[1] / 2).
-                                    lineTo(reX_start - self.layer_dimensions[0] / 2,
-                                           reY_start - self.layer_dimensions[1] / 2).lineTo(
-                    leX_start - self.layer_dimensions[0] / 2, leY_start - self.layer_dimensions[1] / 2).
-                                    close())
-                conductive_trace = conductive_trace.extrude(trace_thickness)
-                base = base.union(conductive_trace)
+        for x_start, y_start, x_end, y_end in selected_layer_geometry.lines:
+            if x_start == x_end:
+                (leX_start, leY_start) = (x_start + self.trace_dimensions[0] ** (6 / 11), y_start)
+                (reX_start, reY_start) = (x_start - self.trace_dimensions[0] ** (6 / 11), y_start)
+
+                (leX_end, leY_end) = (x_end + self.trace_dimensions[0] ** (6 / 11), y_end)
+                (reX_end, reY_end) = (x_end - self.trace_dimensions[0] ** (6 / 11), y_end)
+
+            elif y_start == y_end:
+                (leX_start, leY_start) = (x_start, y_start - self.trace_dimensions[0] ** (6 / 11))
+                (reX_start, reY_start) = (x_start, y_start + self.trace_dimensions[0] ** (6 / 11))
+
+                (leX_end, leY_end) = (x_end, y_end - self.trace_dimensions[0] ** (6 / 11))
+                (reX_end, reY_end) = (x_end, y_end + self.trace_dimensions[0] ** (6 / 11))
+
+            elif ((x_start < x_end) and (y_start < y_end)) or ((x_start > x_end) and (y_start > y_end)):
+                (leX_start, leY_start) = (
+                    x_start - (math.sqrt(self.trace_dimensions[0]) / 2),
+                    y_start + (math.sqrt(self.trace_dimensions[0]) / 2))
+                (reX_start, reY_start) = (
+                    x_start + (math.sqrt(self.trace_dimensions[0]) / 2),
+                    y_start - (math.sqrt(self.trace_dimensions[0]) / 2))
+
+                (leX_end, leY_end) = (x_end - (math.sqrt(self.trace_dimensions[0]) / 2),
+                                      y_end + (math.sqrt(self.trace_dimensions[0]) / 2))
+                (reX_end, reY_end) = (x_end + (math.sqrt(self.trace_dimensions[0]) / 2),
+                                      y_end - (math.sqrt(self.trace_dimensions[0]) / 2))
+
+            elif ((x_start < x_end) and (y_start > y_end)) or ((x_start > x_end) and (y_start < y_end)):
+                (leX_start, leY_start) = (
+                    x_start - (math.sqrt(self.trace_dimensions[0]) / 2),
+                    y_start - (math.sqrt(self.trace_dimensions[0]) / 2))
+                (reX_start, reY_start) = (
+                    x_start + (math.sqrt(self.trace_dimensions[0]) / 2),
+                    y_start + (math.sqrt(self.trace_dimensions[0]) / 2))
+
+                (leX_end, leY_end) = (x_end - (math.sqrt(self.trace_dimensions[0]) / 2),
+                                      y_end - (math.sqrt(self.trace_dimensions[0]) / 2))
+                (reX_end, reY_end) = (x_end + (math.sqrt(self.trace_dimensions[0]) / 2),
+                                      y_end + (math.sqrt(self.trace_dimensions[0]) / 2))
+
+            conductive_trace = (cq.Workplane("XY").moveTo(leX_start - self.layer_dimensions[0] / 2,
+                                                          leY_start - self.layer_dimensions[1] / 2).
+                                lineTo(leX_end - self.layer_dimensions[0] / 2,
+                                       leY_end - self.layer_dimensions[1] / 2).lineTo(
+                reX_end - self.layer_dimensions[0] / 2, reY_end - self.layer_dimensions[1] / 2).
+                                lineTo(reX_start - self.layer_dimensions[0] / 2,
+                                       reY_start - self.layer_dimensions[1] / 2).lineTo(
+                leX_start - self.layer_dimensions[0] / 2, leY_start - self.layer_dimensions[1] / 2).
+                                close())
+            conductive_trace = conductive_trace.extrude(trace_thickness)
+            base = base.union(conductive_trace)
+
+        polylines = self.add_polylines(selected_layer, selected_layer_geometry, trace_thickness)
+        if polylines is not None:
+            base = union_or_compound(base, polylines)
+
+        hatches = self.add_hatches(selected_layer, selected_layer_geometry, trace_thickness, extrude_from_layer)
+        if hatches is not None:
+            base = union_or_compound(base, hatches)
+
+        if include_arcs:
+            arcs = self.add_arcs(selected_layer, selected_layer_geometry, trace_thickness)
+            if arcs is not None:
+                base = union_or_compound(base, arcs)
 
         return base
+
+    def add_polylines(self, selected_layer, selected_layer_geometry, trace_thickness):
+        if not selected_layer_geometry.polyline_count():
+            return None
+
+        print(f"Processing {selected_layer}'s polylines")
+
+        starts, ends, bulges, polyline_ids = selected_layer_geometry.polyline_segments()
+
+        # Polylines without a width of their own use the conductive trace width. Variable widths
+        # are approximated by the widest vertex, so that each polyline stays a single outline.
+        widths = np.maximum.reduceat(selected_layer_geometry.polyline_vertices[:, 2:4].max(axis=1),
+                                     selected_layer_geometry.polyline_offsets[:-1])
+        half_widths = np.where(widths > 0, widths / 2, self.trace_dimensions[0] ** (6 / 11))
+
+        segment_offsets = np.searchsorted(polyline_ids, np.arange(selected_layer_geometry.polyline_count() + 1))
+        outlines = []
+        for i in range(selected_layer_geometry.polyline_count()):
+            segments = slice(segment_offsets[i], segment_offsets[i + 1])
+            path = self.path_wire(starts[segments], ends[segments], bulges[segments])
+            if path is None:
+                continue
+
+            if selected_layer_geometry.polyline_closed[i]:
+                # Closed traces are rings between the outward and inward offsets of the path
+                inner = path.offset2D(-half_widths[i], kind="arc") if half_widths[i] else []
+                face = cq.Face.makeFromWires(path.offset2D(half_widths[i], kind="arc")[0], inner)
+            else:
+                face = cq.Face.makeFromWires(path.offset2D(half_widths[i], kind="arc")[0])
+            outlines.append(cq.Solid.extrudeLinear(face, cq.Vector(0, 0, trace_thickness)))
+
+        if not outlines:
+            return None
+        return fuse_all(outlines)
+
+    def path_wire(self, starts, ends, bulges):
+        """
+            Wire through a path's segments (moved to the board's frame), with bulged segments as true arcs
+        """
+        offset = np.array([self.layer_dimensions[0] / 2, self.layer_dimensions[1] / 2])
+        midpoints = bulge_midpoints(starts, ends, bulges) - offset
+        starts, ends = starts - offset, ends - offset
+
+        edges = []
+        for j in range(len(starts)):
+            start, end = cq.Vector(*starts[j], 0), cq.Vector(*ends[j], 0)
+            if bulges[j]:
+                edges.append(cq.Edge.makeThreePointArc(start, cq.Vector(*midpoints[j], 0), end))
+            elif start != end:
+                edges.append(cq.Edge.makeLine(start, end))
+
+        return cq.Wire.assembleEdges(edges) if edges else None
+
+    def add_hatches(self, selected_layer, selected_layer_geometry, trace_thickness, drill_vias):
+        """
+            Extrude each filled polygon (copper pour or filled pad) as a single face with its holes. When the
+            layer has a plane, the holes of the drill map inside the polygon are cut from the face in one
+            2D operation first.
+        """
+        if not selected_layer_geometry.hatch_count():
+            return None
+
+        print(f"Processing {selected_layer}'s filled areas")
+
+        bounds = selected_layer_geometry.hatch_bounds()
+        pours = []
+        for i in range(selected_layer_geometry.hatch_count()):
+            wires = []
+            for ring in selected_layer_geometry.hatch_rings(i):
+                wire = self.path_wire(ring[:, :2], np.roll(ring[:, :2], -1, axis=0), ring[:, 2])
+                if wire is not None:
+                    wires.append(wire)
+            if not wires:
+                continue
+            face = cq.Face.makeFromWires(wires[0], wires[1:])
+
+            if drill_vias:
+                vias = [cq.Face.makeFromWires(cq.Wire.makeCircle(radius, cq.Vector(x - self.layer_dimensions[0] / 2,
+                                                                                   y - self.layer_dimensions[1] / 2,
+                                                                                   0), cq.Vector(0, 0, 1)))
+                        for x, y, radius in self.drill_map.query_rect(*bounds[i])]
+                if vias:
+                    face = face.cut(*vias)
+
+            pours.extend(cq.Solid.extrudeLinear(piece, cq.Vector(0, 0, trace_thickness)) for piece in face.Faces())
+
+        if not pours:
+            return None
+        return fuse_all(pours)
+
+    def arc_primitive(self, radius, sweep, half_width, thickness):
+        """
+            Annular sector solid of the given radius and sweep (degrees), starting at angle 0 and centered
+            on the origin. Solids are cached, so repeated shapes such as rounded trace corners are built once.
+        """
+        key = (int(quantize(radius, DEFAULT_TOLERANCE)), int(quantize(sweep, DEFAULT_ANGLE_TOLERANCE)),
+               int(quantize(half_width, DEFAULT_TOLERANCE)), int(quantize(thickness, DEFAULT_TOLERANCE)))
+        if key in self.arc_primitive_cache:
+            return self.arc_primitive_cache[key]
+
+        outer_radius = radius + half_width
+        inner_radius = max(radius - half_width, 0)
+
+        if sweep >= 360:
+            arc = cq.Workplane("XY").circle(outer_radius)
+            if inner_radius > 0:
+                arc = arc.circle(inner_radius)
+        else:
+            sweep = math.radians(sweep)
+            arc = (cq.Workplane("XY").moveTo(outer_radius, 0).
+                   threePointArc((outer_radius * math.cos(sweep / 2), outer_radius * math.sin(sweep / 2)),
+                                 (outer_radius * math.cos(sweep), outer_radius * math.sin(sweep))))
+            if inner_radius > 0:
+                arc = (arc.lineTo(inner_radius * math.cos(sweep), inner_radius * math.sin(sweep)).
+                       threePointArc((inner_radius * math.cos(sweep / 2), inner_radius * math.sin(sweep / 2)),
+                                     (inner_radius, 0)))
+            else:
+                arc = arc.lineTo(0, 0)
+            arc = arc.close()
+
+        self.arc_primitive_cache[key] = arc.extrude(thickness).val()
+        return self.arc_primitive_cache[key]
+
+    def place_arcs(self, selected_layer, selected_layer_geometry, trace_thickness):
+        """
+            List of (cached arc solid, placement) pairs for the arcs of a layer
+        """
+        if not len(selected_layer_geometry.arcs):
+            return []
+
+        print(f"Processing {selected_layer}'s arcs")
+
+        half_width = self.trace_dimensions[0] ** (6 / 11)
+        x_center, y_center, radius, start_angle, end_angle = selected_layer_geometry.arcs.T
+
+        # DXF arcs run counterclockwise from start to end angle. Equal angles describe a full circle.
+        sweep = np.mod(end_angle - start_angle, 360)
+        sweep[sweep == 0] = 360
+
+        placements = []
+        for i in range(len(radius)):
+            arc = self.arc_primitive(radius[i], sweep[i], half_width, trace_thickness)
+            placements.append((arc, cq.Location(cq.Vector(x_center[i] - self.layer_dimensions[0] / 2,
+                                                          y_center[i] - self.layer_dimensions[1] / 2, 0),
+                                                cq.Vector(0, 0, 1), float(start_angle[i]))))
+
+        return placements
+
+    def add_arcs(self, selected_layer, selected_layer_geometry, trace_thickness):
+        placed_arcs = [arc.moved(location) for arc, location in
+                       self.place_arcs(selected_layer, selected_layer_geometry, trace_thickness)]
+        if not placed_arcs:
+            return None
+
+        return fuse_all(placed_arcs)
+
+
+class TestArcs(unittest.TestCase):
+
+    def setUp(self):
+        self.working_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        # A 1 x 1 board, so that the board's center is the origin of the solids
+        self.generator = GenerateSteps({}, {}, 1, 1, 0.04, 0.00005, 0.01)
+
+    def tearDown(self):
+        os.chdir(self.working_directory)
+        shutil.rmtree(self.directory)
+
+    def test_arc_primitive(self):
+        ring_area = math.pi * (0.11 ** 2 - 0.09 ** 2)
+        quarter = self.generator.arc_primitive(0.1, 90, 0.01, 0.02)
+        self.assertAlmostEqual(quarter.Volume(), ring_area * 0.02 / 4, places=8)
+        self.assertAlmostEqual(self.generator.arc_primitive(0.1, 360, 0.01, 0.02).Volume(), ring_area * 0.02, places=8)
+
+        # The same shape within tolerance is a cache hit
+        self.assertIs(self.generator.arc_primitive(0.1 + 1e-8, 90, 0.01, 0.02), quarter)
+        self.assertEqual(len(self.generator.arc_primitive_cache), 2)
+
+    def test_place_arcs(self):
+        geometry = LayerGeometry(arcs=[(0.5, 0.5, 0.1, 90, 180), (0.5, 0.5, 0.1, 0, 90), (0.7, 0.7, 0.1, 30, 30)])
+        placements = self.generator.place_arcs("TOP", geometry, 0.01)
+
+        # Both quarter arcs share one solid, the arc with equal angles is a full ring
+        self.assertIs(placements[0][0], placements[1][0])
+        self.assertEqual(len(self.generator.arc_primitive_cache), 2)
+
+        # The solid starts at angle 0 and is rotated to the start angle of each arc
+        half_width = 0.00005 ** (6 / 11)
+        second_quadrant = placements[0][0].moved(placements[0][1]).BoundingBox()
+        self.assertAlmostEqual(second_quadrant.xmin, -0.1 - half_width, places=4)
+        self.assertAlmostEqual(second_quadrant.xmax, 0, places=4)
+        self.assertAlmostEqual(second_quadrant.ymax, 0.1 + half_width, places=4)
+        first_quadrant = placements[1][0].moved(placements[1][1]).BoundingBox()
+        self.assertAlmostEqual(first_quadrant.xmax, 0.1 + half_width, places=4)
+        self.assertAlmostEqual(first_quadrant.ymin, 0, places=4)
+
+        ring = placements[2][0].moved(placements[2][1]).BoundingBox()
+        self.assertAlmostEqual(ring.xmin, 0.2 - 0.1 - half_width, places=4)
+        self.assertAlmostEqual(ring.ymax, 0.2 + 0.1 + half_width, places=4)
+
+
+class TestPolylines(unittest.TestCase):
+
+    def setUp(self):
+        self.working_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.generator = GenerateSteps({}, {}, 1, 1, 0.04, 0.00005, 0.01)
+
+    def tearDown(self):
+        os.chdir(self.working_directory)
+        shutil.rmtree(self.directory)
+
+    def test_wide_bulged_polyline_is_one_solid(self):
+        # A half circle of radius 0.2 below its chord, then a straight segment up
+        geometry = LayerGeometry(polyline_vertices=[(0.3, 0.5, 0.04, 0.04, 1), (0.7, 0.5, 0.04, 0.04, 0),
+                                                    (0.7, 0.7, 0.04, 0.04, 0)],
+                                 polyline_offsets=[0, 3], polyline_closed=[False])
+        trace = self.generator.add_polylines("TOP", geometry, 0.01)
+
+        self.assertEqual(len(trace.Solids()), 1)
+        self.assertTrue(trace.isValid())
+        bounds = trace.BoundingBox()
+        self.assertAlmostEqual(bounds.xmin, -0.2 - 0.02, places=6)
+        self.assertAlmostEqual(bounds.xmax, 0.2 + 0.02, places=6)
+        self.assertAlmostEqual(bounds.ymin, -0.2 - 0.02, places=6)
+        self.assertAlmostEqual(bounds.ymax, 0.2 + 0.02, places=6)
+
+    def test_closed_polyline_is_a_ring(self):
+        square = [(0.2, 0.2, 0.04, 0.04, 0), (0.8, 0.2, 0.04, 0.04, 0), (0.8, 0.8, 0.04, 0.04, 0),
+                  (0.2, 0.8, 0.04, 0.04, 0)]
+        geometry = LayerGeometry(polyline_vertices=square, polyline_offsets=[0, 4], polyline_closed=[True])
+        ring = self.generator.add_polylines("TOP", geometry, 0.01)
+
+        self.assertEqual(len(ring.Solids()), 1)
+        self.assertTrue(ring.isValid())
+        # The outward offset has rounded corners, the inward offset has sharp ones
+        outer_area = 0.64 ** 2 - (4 - math.pi) * 0.02 ** 2
+        self.assertAlmostEqual(ring.Volume(), (outer_area - 0.56 ** 2) * 0.01, places=8)
+
+
+class TestHatches(unittest.TestCase):
+
+    def setUp(self):
+        self.working_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.generator = GenerateSteps({}, {}, 1, 1, 0.04, 0.00005, 0.01)
+        # A square pour with a square island
+        outer = [(0.2, 0.2, 0), (0.8, 0.2, 0), (0.8, 0.8, 0), (0.2, 0.8, 0)]
+        island = [(0.4, 0.4, 0), (0.6, 0.4, 0), (0.6, 0.6, 0), (0.4, 0.6, 0)]
+        self.geometry = LayerGeometry(hatch_vertices=outer + island, hatch_ring_offsets=[0, 4, 8],
+                                      hatch_polygon_offsets=[0, 2])
+
+    def tearDown(self):
+        os.chdir(self.working_directory)
+        shutil.rmtree(self.directory)
+
+    def test_island_is_cut_from_the_pour(self):
+        pour = self.generator.add_hatches("TOP", self.geometry, 0.01, False)
+        self.assertTrue(pour.isValid())
+        self.assertAlmostEqual(pour.Volume(), (0.6 ** 2 - 0.2 ** 2) * 0.01, places=8)
+
+    def test_vias_inside_the_pour_are_drilled_in_plane_mode(self):
+        # One via in the pour, one in the island and one outside of the pour
+        self.generator.drill_map = DrillMap([(0.3, 0.3, 0.02), (0.5, 0.5, 0.02), (0.9, 0.9, 0.02)]).on_board(1, 1)
+        area = 0.6 ** 2 - 0.2 ** 2
+        self.assertAlmostEqual(self.generator.add_hatches("TOP", self.geometry, 0.01, False).Volume(), area * 0.01,
+                               places=8)
+        self.assertAlmostEqual(self.generator.add_hatches("TOP", self.geometry, 0.01, True).Volume(),
+                               (area - math.pi * 0.02 ** 2) * 0.01, places=8)
+
+
+class TestInstancedOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.working_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.working_directory)
+        shutil.rmtree(self.directory)
+
+    def step_size(self, geometry, option, **arguments):
+        GenerateSteps({"TOP": geometry}, {"TOP": option}, 1, 1, 0.04, 0.00005, 0.01, **arguments)
+        return os.path.getsize(step_file_name("TOP"))
+
+    def test_panel_size_does_not_grow_with_copies(self):
+        holes = [(0.1 + 0.15 * i, 0.1 + 0.15 * j, 0.01) for i in range(5) for j in range(5)]
+        board = LayerGeometry(lines=[(0.1, 0.05, 0.9, 0.05)], circles=holes)
+
+        single = self.step_size(board, "Conductive Traces AND Vias AND Plane")
+        panel = self.step_size(board, "Conductive Traces AND Vias AND Plane", panel_rows=4, panel_columns=4)
+        # 15 more boards cost a fraction of one board
+        self.assertLess(panel - single, single / 5)
+
+    def test_instanced_size_grows_with_unique_arcs_only(self):
+        def arcs(count):
+            return LayerGeometry(arcs=[(0.1 + 0.05 * i, 0.5, 0.02, 0, 90) for i in range(count)])
+
+        few = self.step_size(arcs(4), "Conductive Traces only", instanced=True)
+        many = self.step_size(arcs(16), "Conductive Traces only", instanced=True)
+        # Every extra arc is a reference to the same solid, much smaller than the file of a single arc
+        self.assertLess((many - few) / 12, self.step_size(arcs(1), "Conductive Traces only", instanced=True) / 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
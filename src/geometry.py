@@ -0,0 +1,871 @@
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from src.lazy import LazyModule
+from src.spatialindex import LayerIndex
+
+# Only needed to read HATCH entities, which means that ezdxf is already loaded
+boundary_paths = LazyModule("ezdxf.entities.boundary_paths")
+
+# Coordinates are quantized to integer multiples of this step (inches) before they are compared
+DEFAULT_TOLERANCE = 1e-6
+
+# Angles (degrees) are quantized to integer multiples of this step before they are compared
+DEFAULT_ANGLE_TOLERANCE = 1e-6
+
+
+def quantize(values, tolerance):
+    """
+        Snap floating point values to integer multiples of the tolerance so that
+        near-identical coordinates hash and sort as exact duplicates
+    """
+    return np.rint(np.asarray(values, dtype=np.float64) / tolerance).astype(np.int64)
+
+
+def merge_radii(radii, tolerance):
+    """
+        Bucket radii that are within tolerance of each other. Returns the integer key of each
+        radius, and the radii rewritten to the first radius seen in their bucket, so that
+        callers grouping by radius see a single value per bucket
+    """
+    keys = quantize(radii, tolerance)
+    if len(keys) == 0:
+        return keys, np.asarray(radii, dtype=np.float64)
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    merged = np.asarray(radii, dtype=np.float64)[first][inverse.reshape(-1)]
+    return keys, merged
+
+
+def _unique_rows(keys):
+    """
+        Indices of the first occurrence of each unique row of an integer key array, in input order
+    """
+    if len(keys) == 0:
+        return np.arange(0)
+    _, first = np.unique(keys, axis=0, return_index=True)
+    first.sort()
+    return first
+
+
+def _array(values, columns, dtype=np.float64):
+    if values is None:
+        return np.empty((0, columns), dtype=dtype)
+    return np.asarray(values, dtype=dtype).reshape(-1, columns)
+
+
+def _offsets(lengths):
+    return np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+
+
+def _select_ranges(offsets, indices):
+    """
+        Positions of the items owned by the given ranges of a packed array, and the offsets of
+        those ranges once packed on their own
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    lengths = np.diff(offsets)[indices]
+    selected_offsets = _offsets(lengths)
+    positions = np.repeat(offsets[indices] - selected_offsets[:-1], lengths) + np.arange(selected_offsets[-1])
+    return positions, selected_offsets
+
+
+def path_segments(offsets, closed):
+    """
+        Vertex indices of the start and end of every segment of a set of packed paths, in path order,
+        with the path each segment belongs to. Closed paths get an extra segment from their last vertex
+        back to their first.
+    """
+    vertex_count = offsets[-1]
+    starts = np.arange(vertex_count)
+    ends = starts + 1
+    path_ids = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+    # The last vertex of a path starts a segment only if the path is closed
+    last_vertices = offsets[1:] - 1
+    ends[last_vertices] = offsets[:-1]
+    has_segment = np.ones(vertex_count, dtype=bool)
+    has_segment[last_vertices[~np.asarray(closed, dtype=bool)]] = False
+
+    return starts[has_segment], ends[has_segment], path_ids[has_segment]
+
+
+def path_bounds(points, bulges, offsets, closed):
+    """
+        (K, 4) bounding boxes of a set of packed paths, including their bulged segments (taken as full circles)
+    """
+    if len(offsets) < 2:
+        return np.empty((0, 4))
+
+    bounds = np.column_stack((np.minimum.reduceat(points, offsets[:-1], axis=0),
+                              np.maximum.reduceat(points, offsets[:-1], axis=0)))
+
+    starts, ends, path_ids = path_segments(offsets, closed)
+    curved = bulges[starts] != 0
+    arcs = bulge_to_arcs(points[starts[curved]], points[ends[curved]], bulges[starts[curved]])
+    for column, sign in ((0, -1), (1, -1), (2, 1), (3, 1)):
+        extreme = np.minimum if sign < 0 else np.maximum
+        extreme.at(bounds[:, column], path_ids[curved], arcs[:, column % 2] + sign * arcs[:, 2])
+
+    return bounds
+
+
+class LayerGeometry:
+    """
+        LayerGeometry stores the primitives of a layer as columnar NumPy arrays instead
+        of ezdxf entity wrappers, so that whole layers can be filtered and compared at once.
+
+        Attributes
+        ----------
+        lines : numpy.ndarray
+            (N, 4) array of segments stored as x_start, y_start, x_end, y_end
+
+        circles : numpy.ndarray
+            (N, 3) array of circles stored as x_center, y_center, radius
+
+        arcs : numpy.ndarray
+            (N, 5) array of arcs stored as x_center, y_center, radius, start_angle, end_angle (degrees)
+
+        polyline_vertices : numpy.ndarray
+            (M, 5) array of the vertices of all polylines stored as x, y, start_width, end_width, bulge.
+            The bulge of a vertex describes the segment that starts at that vertex.
+
+        polyline_offsets : numpy.ndarray
+            (K + 1,) array, polyline i owns vertices polyline_offsets[i] to polyline_offsets[i + 1]
+
+        polyline_closed : numpy.ndarray
+            (K,) boolean array, True if the last vertex of the polyline connects back to the first
+
+        hatch_vertices : numpy.ndarray
+            (V, 3) array of the vertices of all filled polygon rings stored as x, y, bulge. Rings are closed.
+
+        hatch_ring_offsets : numpy.ndarray
+            (R + 1,) array, ring i owns vertices hatch_ring_offsets[i] to hatch_ring_offsets[i + 1]
+
+        hatch_polygon_offsets : numpy.ndarray
+            (P + 1,) array, polygon i owns rings hatch_polygon_offsets[i] to hatch_polygon_offsets[i + 1].
+            The first ring of a polygon is its outer boundary, the others are its holes.
+
+        directory : str
+            GeometryStore layer directory of memory-mapped geometry, None for geometry held in memory.
+            Memory-mapped geometry is pickled (e.g. to hand it to another process) as this path, and
+            opened again on the other side, instead of as a copy of its arrays.
+
+        Methods
+        -------
+        from_entities()
+            Build the arrays from a list of ezdxf entities, using the handler registered for each
+            entity type in ENTITY_HANDLERS. Entities of other types are skipped.
+
+        count()
+            Total number of primitives stored in the layer
+
+        select()
+            Subset of the layer with the given primitives of each kind
+
+        polyline_segments()
+            Split polylines into straight segments and arcs
+
+        hatch_rings()
+            Vertices of the rings of a filled polygon
+
+        get_index()
+            Spatial index over the layer's arrays. It is built on first use and then kept with the geometry.
+    """
+
+    def __init__(self, lines=None, circles=None, arcs=None, polyline_vertices=None, polyline_offsets=None,
+                 polyline_closed=None, hatch_vertices=None, hatch_ring_offsets=None, hatch_polygon_offsets=None):
+        self.index = None
+        self.directory = None
+        self.lines = _array(lines, 4)
+        self.circles = _array(circles, 3)
+        self.arcs = _array(arcs, 5)
+        self.polyline_vertices = _array(polyline_vertices, 5)
+        self.polyline_offsets = np.asarray(polyline_offsets if polyline_offsets is not None else [0], dtype=np.int64)
+        self.polyline_closed = np.asarray(polyline_closed if polyline_closed is not None else [], dtype=bool)
+        self.hatch_vertices = _array(hatch_vertices, 3)
+        self.hatch_ring_offsets = np.asarray(hatch_ring_offsets if hatch_ring_offsets is not None else [0],
+                                             dtype=np.int64)
+        self.hatch_polygon_offsets = np.asarray(hatch_polygon_offsets if hatch_polygon_offsets is not None else [0],
+                                                dtype=np.int64)
+
+    @classmethod
+    def from_entities(cls, entities):
+        # Group entities by type once, then extract each type in bulk
+        entity_type_to_entities = {}
+        for entity in entities:
+            entity_type_to_entities.setdefault(entity.dxftype(), []).append(entity)
+
+        columns = {}
+        for entity_type, typed_entities in entity_type_to_entities.items():
+            if entity_type in ENTITY_HANDLERS:
+                for column, values in ENTITY_HANDLERS[entity_type](typed_entities).items():
+                    columns.setdefault(column, []).extend(values)
+
+        # Polylines are extracted as (vertices, closed) pairs and packed into a single vertex array
+        polylines = [(vertices, closed) for vertices, closed in columns.get('polylines', []) if len(vertices) > 1]
+        polyline_vertices = np.concatenate([vertices for vertices, _ in polylines]) if polylines else None
+
+        # Filled polygons are extracted as lists of rings, outer boundary first
+        rings = [ring for polygon in columns.get('hatches', []) for ring in polygon]
+        hatch_vertices = np.concatenate(rings) if rings else None
+
+        return cls(columns.get('lines'), columns.get('circles'), columns.get('arcs'), polyline_vertices,
+                   _offsets([len(vertices) for vertices, _ in polylines]), [closed for _, closed in polylines],
+                   hatch_vertices, _offsets([len(ring) for ring in rings]),
+                   _offsets([len(polygon) for polygon in columns.get('hatches', [])]))
+
+    def polyline_count(self):
+        return len(self.polyline_closed)
+
+    def hatch_count(self):
+        return len(self.hatch_polygon_offsets) - 1
+
+    def count(self):
+        return len(self.lines) + len(self.circles) + len(self.arcs) + self.polyline_count() + self.hatch_count()
+
+    def select_polylines(self, indices):
+        """
+            Returns the vertices, offsets, and closed flags of the given polylines, packed like the layer's own
+        """
+        vertices, offsets = _select_ranges(self.polyline_offsets, indices)
+        return self.polyline_vertices[vertices], offsets, self.polyline_closed[np.asarray(indices, dtype=np.int64)]
+
+    def select_hatches(self, indices):
+        """
+            Returns the vertices, ring offsets, and polygon offsets of the given polygons, packed like the layer's own
+        """
+        rings, polygon_offsets = _select_ranges(self.hatch_polygon_offsets, indices)
+        vertices, ring_offsets = _select_ranges(self.hatch_ring_offsets, rings)
+        return self.hatch_vertices[vertices], ring_offsets, polygon_offsets
+
+    def select(self, lines=None, circles=None, arcs=None, polylines=None, hatches=None):
+        """
+            New LayerGeometry with the given indices of each kind of primitive. Kinds that are not given are kept whole.
+        """
+        def indices(selected, count):
+            return np.arange(count) if selected is None else np.asarray(selected, dtype=np.int64)
+
+        return LayerGeometry(self.lines[indices(lines, len(self.lines))],
+                             self.circles[indices(circles, len(self.circles))],
+                             self.arcs[indices(arcs, len(self.arcs))],
+                             *self.select_polylines(indices(polylines, self.polyline_count())),
+                             *self.select_hatches(indices(hatches, self.hatch_count())))
+
+    def polyline_segments(self):
+        """
+            Returns the start points, end points, bulges, and owning polyline of every polyline segment,
+            in path order. Closed polylines get an extra segment from their last vertex to their first.
+        """
+        starts, ends, polyline_ids = path_segments(self.polyline_offsets, self.polyline_closed)
+        return (self.polyline_vertices[starts, :2], self.polyline_vertices[ends, :2],
+                self.polyline_vertices[starts, 4], polyline_ids)
+
+    def hatch_rings(self, polygon):
+        """
+            List of (x, y, bulge) vertex arrays of the rings of a polygon, outer boundary first
+        """
+        first_ring, last_ring = self.hatch_polygon_offsets[polygon], self.hatch_polygon_offsets[polygon + 1]
+        return [self.hatch_vertices[self.hatch_ring_offsets[ring]:self.hatch_ring_offsets[ring + 1]]
+                for ring in range(first_ring, last_ring)]
+
+    def polyline_bounds(self):
+        """
+            (K, 4) bounding boxes of the polylines, including their bulged segments (taken as full circles)
+            and half of their widest vertex
+        """
+        bounds = path_bounds(self.polyline_vertices[:, :2], self.polyline_vertices[:, 4], self.polyline_offsets,
+                             self.polyline_closed)
+        if len(bounds):
+            half_widths = np.maximum.reduceat(self.polyline_vertices[:, 2:4].max(axis=1),
+                                              self.polyline_offsets[:-1]) / 2
+            bounds[:, :2] -= half_widths[:, None]
+            bounds[:, 2:] += half_widths[:, None]
+        return bounds
+
+    def hatch_bounds(self):
+        """
+            (P, 4) bounding boxes of the filled polygons, given by their outer rings
+        """
+        ring_bounds = path_bounds(self.hatch_vertices[:, :2], self.hatch_vertices[:, 2], self.hatch_ring_offsets,
+                                  np.ones(len(self.hatch_ring_offsets) - 1, dtype=bool))
+        return ring_bounds[self.hatch_polygon_offsets[:-1]]
+
+    def get_index(self):
+        if self.index is None:
+            self.index = LayerIndex(self)
+        return self.index
+
+    def __reduce_ex__(self, protocol):
+        if self.directory is not None:
+            return read_geometry_directory, (self.directory,)
+        return super().__reduce_ex__(protocol)
+
+    def __getstate__(self):
+        # The spatial index is built again on demand
+        return dict(self.__dict__, index=None)
+
+
+# Names of the arrays that make up a LayerGeometry, in constructor order
+GEOMETRY_ARRAYS = ('lines', 'circles', 'arcs', 'polyline_vertices', 'polyline_offsets', 'polyline_closed',
+                   'hatch_vertices', 'hatch_ring_offsets', 'hatch_polygon_offsets')
+
+
+class GeometryStore:
+    """
+        GeometryStore keeps the geometry arrays of layers out of memory, in a scratch directory with one
+        .npy file per layer and array. Layers are read back as LayerGeometry objects whose arrays are
+        read-only memory maps, so only the pages that are used are loaded, and the operating system can
+        drop them again under memory pressure.
+
+        Attributes
+        ----------
+        directory : str
+            Scratch directory of the store. The layers.json manifest maps layer names to the
+            subdirectories holding their arrays.
+
+        Methods
+        -------
+        write()
+            Write the arrays of a layer, and return the layer read back from the new files
+
+        read()
+            Memory-mapped geometry of a layer
+
+        remove()
+            Delete the files of a layer
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest = os.path.join(self.directory, "layers.json")
+
+        self.layer_to_directory = {}
+        if os.path.exists(self.manifest):
+            with open(self.manifest) as manifest:
+                self.layer_to_directory = json.load(manifest)
+
+    def layers(self):
+        return list(self.layer_to_directory)
+
+    def write(self, layer, geometry):
+        # Every write goes to a new directory, so that memory maps of the previous revision of the layer
+        # are not truncated under their readers
+        layer_directory = tempfile.mkdtemp(prefix="layer_", dir=self.directory)
+        for name in GEOMETRY_ARRAYS:
+            np.save(os.path.join(layer_directory, f"{name}.npy"), np.ascontiguousarray(getattr(geometry, name)))
+
+        self.remove(layer)
+        self.layer_to_directory[layer] = os.path.basename(layer_directory)
+        self.save_manifest()
+        return self.read(layer)
+
+    def read(self, layer):
+        return read_geometry_directory(self.layer_path(layer))
+
+    def layer_path(self, layer):
+        return os.path.join(self.directory, self.layer_to_directory[layer])
+
+    def remove(self, layer):
+        if layer in self.layer_to_directory:
+            # Open memory maps keep the data of deleted files alive on POSIX systems
+            shutil.rmtree(self.layer_path(layer), ignore_errors=True)
+            del self.layer_to_directory[layer]
+            self.save_manifest()
+
+    def save_manifest(self):
+        temporary_manifest = f"{self.manifest}.tmp"
+        with open(temporary_manifest, "w") as manifest:
+            json.dump(self.layer_to_directory, manifest)
+        os.replace(temporary_manifest, self.manifest)
+
+
+def read_geometry_directory(layer_directory):
+    """
+        LayerGeometry backed by read-only memory maps of the .npy files of a GeometryStore layer directory
+    """
+    geometry = LayerGeometry(*(np.load(os.path.join(layer_directory, f"{name}.npy"), mmap_mode="r")
+                               for name in GEOMETRY_ARRAYS))
+    geometry.directory = layer_directory
+    return geometry
+
+
+def bulge_to_arcs(start, end, bulge):
+    """
+        Convert polyline segments with a non-zero bulge to arcs stored as x_center, y_center, radius,
+        start_angle, end_angle. The bulge is the tangent of a quarter of the included angle, positive
+        for counterclockwise segments. DXF arcs always run counterclockwise, so clockwise segments
+        get their endpoints swapped.
+    """
+    chord = end - start
+    chord_length = np.hypot(chord[:, 0], chord[:, 1])
+    left_normal = np.column_stack((-chord[:, 1], chord[:, 0])) / chord_length[:, None]
+
+    center = (start + end) / 2 + left_normal * (chord_length * (1 - bulge ** 2) / (4 * bulge))[:, None]
+    radius = chord_length * (1 + bulge ** 2) / (4 * np.abs(bulge))
+
+    start_angle = np.degrees(np.arctan2(start[:, 1] - center[:, 1], start[:, 0] - center[:, 0]))
+    end_angle = np.degrees(np.arctan2(end[:, 1] - center[:, 1], end[:, 0] - center[:, 0]))
+    clockwise = bulge < 0
+    start_angle[clockwise], end_angle[clockwise] = end_angle[clockwise], start_angle[clockwise]
+
+    return np.column_stack((center, radius, np.mod(start_angle, 360), np.mod(end_angle, 360)))
+
+
+def bulge_midpoints(start, end, bulge):
+    """
+        Point halfway along each bulged segment, which is what three-point arc constructors expect
+    """
+    chord = end - start
+    left_normal = np.column_stack((-chord[:, 1], chord[:, 0]))
+    return (start + end) / 2 - left_normal * (bulge / 2)[:, None]
+
+
+# Maps DXF entity types to the function that extracts all entities of that type of a layer into
+# geometry columns. Supported entity types are the keys of this dictionary.
+ENTITY_HANDLERS = {}
+
+
+def entity_handler(entity_type):
+    """
+        Register the decorated function as the extractor of the given DXF entity type
+    """
+    def register(handler):
+        ENTITY_HANDLERS[entity_type] = handler
+        return handler
+
+    return register
+
+
+@entity_handler('LINE')
+def extract_lines(entities):
+    return {'lines': [(e.dxf.start[0], e.dxf.start[1], e.dxf.end[0], e.dxf.end[1]) for e in entities]}
+
+
+@entity_handler('CIRCLE')
+def extract_circles(entities):
+    return {'circles': [(e.dxf.center[0], e.dxf.center[1], e.dxf.radius) for e in entities]}
+
+
+@entity_handler('ARC')
+def extract_arcs(entities):
+    return {'arcs': [(e.dxf.center[0], e.dxf.center[1], e.dxf.radius, e.dxf.start_angle, e.dxf.end_angle)
+                     for e in entities]}
+
+
+@entity_handler('LWPOLYLINE')
+def extract_lwpolylines(entities):
+    polylines = []
+    for entity in entities:
+        vertices = np.array(entity.get_points('xyseb'), dtype=np.float64).reshape(-1, 5)
+        # A constant width applies when the vertices do not define their own widths
+        if entity.dxf.const_width and not vertices[:, 2:4].any():
+            vertices[:, 2:4] = entity.dxf.const_width
+        polylines.append((vertices, entity.closed))
+
+    return {'polylines': polylines}
+
+
+@entity_handler('POLYLINE')
+def extract_polylines(entities):
+    polylines = []
+    for entity in entities:
+        # 3D polylines and meshes do not describe traces
+        if not entity.is_2d_polyline:
+            continue
+        vertices = np.array([(v.dxf.location[0], v.dxf.location[1], v.dxf.start_width, v.dxf.end_width, v.dxf.bulge)
+                             for v in entity.vertices], dtype=np.float64).reshape(-1, 5)
+        if not vertices[:, 2:4].any():
+            vertices[:, 2] = entity.dxf.default_start_width
+            vertices[:, 3] = entity.dxf.default_end_width
+        polylines.append((vertices, entity.is_closed))
+
+    return {'polylines': polylines}
+
+
+@entity_handler('HATCH')
+def extract_hatches(entities):
+    polygons = []
+    for entity in entities:
+        rings = [ring for ring in (boundary_path_vertices(path) for path in entity.paths) if encloses_area(ring)]
+        polygons.extend(nest_rings(rings, entity.dxf.hatch_style))
+
+    return {'hatches': polygons}
+
+
+def encloses_area(ring):
+    """
+        Whether a ring of x, y, bulge vertices has an area. Two vertices do when one of their segments is
+        bulged, e.g. a round pad drawn as two half circles.
+    """
+    return len(ring) > 2 or (len(ring) == 2 and bool(ring[:, 2].any()))
+
+
+def boundary_path_vertices(path, distance=1e-4):
+    """
+        Convert a HATCH boundary path to an (n, 3) array of x, y, bulge. Polyline paths, line edges,
+        and arc edges are kept exact. Ellipse and spline edges are flattened to within distance (inches).
+    """
+    if path.type == boundary_paths.BoundaryPathType.POLYLINE:
+        return np.array([(x, y, bulge) for x, y, bulge in path.vertices], dtype=np.float64).reshape(-1, 3)
+
+    vertices = []
+    for edge in path.edges:
+        if edge.type == boundary_paths.EdgeType.LINE:
+            vertices.append((edge.start[0], edge.start[1], 0))
+        elif edge.type == boundary_paths.EdgeType.ARC:
+            # Angles are stored counterclockwise, the ccw flag gives the direction the edge is walked in
+            sweep = (edge.end_angle - edge.start_angle) % 360 or 360
+            start = edge.start_point if edge.ccw else edge.end_point
+            direction = 1 if edge.ccw else -1
+            if sweep == 360:
+                # A full circle starts and ends on the same point, so it is walked as two half circles
+                opposite = 2 * np.array((edge.center[0], edge.center[1])) - np.array((start[0], start[1]))
+                vertices.append((start[0], start[1], direction))
+                vertices.append((opposite[0], opposite[1], direction))
+            else:
+                vertices.append((start[0], start[1], direction * np.tan(np.radians(sweep) / 4)))
+        else:
+            points = list(edge.construction_tool().flattening(distance))
+            if edge.type == boundary_paths.EdgeType.ELLIPSE and not edge.ccw:
+                points.reverse()
+            vertices.extend((point[0], point[1], 0) for point in points[:-1])
+
+    return np.array(vertices, dtype=np.float64).reshape(-1, 3)
+
+
+def point_in_ring(x, y, ring):
+    """
+        Even-odd test of a point against the straight-line outline of a ring
+    """
+    xs, ys = ring[:, 0], ring[:, 1]
+    next_xs, next_ys = np.roll(xs, -1), np.roll(ys, -1)
+    straddles = (ys > y) != (next_ys > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossings = straddles & (x < (next_xs - xs) * (y - ys) / (next_ys - ys) + xs)
+    return bool(crossings.sum() % 2)
+
+
+def nest_rings(rings, hatch_style=0):
+    """
+        Group the rings of a HATCH into polygons with holes. A ring nested inside an even number of
+        other rings is an outer boundary, and the rings directly inside it are its holes. Islands inside
+        holes become polygons of their own. Hatch style 1 (outer) stops after the first level of holes,
+        and style 2 (ignore) only keeps the outermost boundaries.
+    """
+    containers = [[j for j in range(len(rings)) if j != i and point_in_ring(rings[i][0, 0], rings[i][0, 1], rings[j])]
+                  for i in range(len(rings))]
+    depths = [len(container) for container in containers]
+    max_depth = {0: None, 1: 1, 2: 0}.get(hatch_style)
+
+    polygons = []
+    for i, depth in enumerate(depths):
+        if depth % 2 or (max_depth is not None and depth > max_depth):
+            continue
+        holes = [rings[j] for j in range(len(rings)) if depths[j] == depth + 1 and i in containers[j]
+                 and (max_depth is None or depths[j] <= max_depth)]
+        polygons.append([rings[i]] + holes)
+
+    return polygons
+
+
+def _line_keys(lines, tolerance):
+    """
+        Quantized segments with their endpoints ordered, so a segment and its reverse share a key
+    """
+    keys = quantize(lines, tolerance)
+    reversed_lines = (keys[:, 0] > keys[:, 2]) | ((keys[:, 0] == keys[:, 2]) & (keys[:, 1] > keys[:, 3]))
+    keys[reversed_lines] = keys[reversed_lines][:, [2, 3, 0, 1]]
+    return keys
+
+
+def as_layer_geometry(entities_or_geometry):
+    """
+        Accept either a list of ezdxf entities or an already extracted LayerGeometry
+    """
+    if isinstance(entities_or_geometry, LayerGeometry):
+        return entities_or_geometry
+    return LayerGeometry.from_entities(entities_or_geometry)
+
+
+def deduplicate_geometry(geometry, tolerance=DEFAULT_TOLERANCE, radius_tolerance=None,
+                         angle_tolerance=DEFAULT_ANGLE_TOLERANCE):
+    """
+        Remove exact and near-exact duplicate primitives from a layer. Coordinates are quantized
+        to integer multiples of the tolerance and compared as integer rows, so segments that only
+        differ by the direction they were drawn in are also merged. Radii within radius_tolerance
+        (defaults to tolerance) are merged into the same bucket.
+
+        Returns the geometry unchanged if nothing was removed or merged, otherwise a new LayerGeometry.
+    """
+    if radius_tolerance is None:
+        radius_tolerance = tolerance
+
+    # Segments: order the endpoints of each segment so that reversed duplicates share a key
+    kept_lines = _unique_rows(_line_keys(geometry.lines, tolerance))
+
+    # Circles: center and bucketed radius
+    circle_radius_keys, circle_radii = merge_radii(geometry.circles[:, 2], radius_tolerance)
+    circle_keys = np.column_stack((quantize(geometry.circles[:, :2], tolerance), circle_radius_keys))
+    kept_circles = _unique_rows(circle_keys)
+
+    # Arcs: center, bucketed radius, and normalized start and end angles
+    arc_radius_keys, arc_radii = merge_radii(geometry.arcs[:, 2], radius_tolerance)
+    arc_keys = np.column_stack((quantize(geometry.arcs[:, :2], tolerance), arc_radius_keys,
+                                quantize(np.mod(geometry.arcs[:, 3:5], 360.0), angle_tolerance)))
+    kept_arcs = _unique_rows(arc_keys)
+
+    # Polylines: the quantized bytes of all their vertices
+    vertex_keys = quantize(geometry.polyline_vertices, tolerance)
+    polyline_keys = {}
+    for i, (start, end) in enumerate(zip(geometry.polyline_offsets[:-1], geometry.polyline_offsets[1:])):
+        polyline_keys.setdefault((bool(geometry.polyline_closed[i]), vertex_keys[start:end].tobytes()), i)
+    kept_polylines = np.sort(np.fromiter(polyline_keys.values(), dtype=np.int64, count=len(polyline_keys)))
+
+    # Filled polygons: the quantized bytes of all their rings
+    hatch_vertex_keys = quantize(geometry.hatch_vertices, tolerance)
+    hatch_keys = {}
+    for i in range(geometry.hatch_count()):
+        first_ring, last_ring = geometry.hatch_polygon_offsets[i], geometry.hatch_polygon_offsets[i + 1]
+        ring_offsets = geometry.hatch_ring_offsets[first_ring:last_ring + 1]
+        hatch_keys.setdefault((ring_offsets - ring_offsets[0]).tobytes() +
+                              hatch_vertex_keys[ring_offsets[0]:ring_offsets[-1]].tobytes(), i)
+    kept_hatches = np.sort(np.fromiter(hatch_keys.values(), dtype=np.int64, count=len(hatch_keys)))
+
+    unchanged = len(kept_lines) == len(geometry.lines) and len(kept_circles) == len(geometry.circles) \
+        and len(kept_arcs) == len(geometry.arcs) and len(kept_polylines) == geometry.polyline_count() \
+        and len(kept_hatches) == geometry.hatch_count() \
+        and np.array_equal(circle_radii, geometry.circles[:, 2]) and np.array_equal(arc_radii, geometry.arcs[:, 2])
+    if unchanged:
+        return geometry
+
+    circles = geometry.circles.copy()
+    circles[:, 2] = circle_radii
+    arcs = geometry.arcs.copy()
+    arcs[:, 2] = arc_radii
+
+    return LayerGeometry(geometry.lines[kept_lines], circles[kept_circles], arcs[kept_arcs],
+                         *geometry.select_polylines(kept_polylines), *geometry.select_hatches(kept_hatches))
+
+
+def geometry_digest(geometry, tolerance=DEFAULT_TOLERANCE, angle_tolerance=DEFAULT_ANGLE_TOLERANCE):
+    """
+        Hash of the quantized primitives of a layer. Primitives are sorted before hashing, so the digest
+        does not depend on the order the entities were written in, and two revisions of a layer share a
+        digest exactly when they describe the same geometry within tolerance.
+    """
+    digest = hashlib.sha1()
+
+    digest.update(b'lines')
+    digest.update(np.unique(_line_keys(geometry.lines, tolerance), axis=0).tobytes())
+    digest.update(b'circles')
+    digest.update(np.unique(quantize(geometry.circles, tolerance), axis=0).tobytes())
+    digest.update(b'arcs')
+    digest.update(np.unique(np.column_stack((quantize(geometry.arcs[:, :3], tolerance),
+                                             quantize(np.mod(geometry.arcs[:, 3:5], 360.0), angle_tolerance))),
+                            axis=0).tobytes())
+
+    # Paths are hashed one by one, and the sorted path hashes are hashed together
+    vertex_keys = quantize(geometry.polyline_vertices, tolerance)
+    polylines = sorted(hashlib.sha1(bytes([int(closed)]) + vertex_keys[start:end].tobytes()).digest()
+                       for closed, start, end in zip(geometry.polyline_closed, geometry.polyline_offsets[:-1],
+                                                     geometry.polyline_offsets[1:]))
+    digest.update(b'polylines')
+    digest.update(b''.join(polylines))
+
+    hatch_vertex_keys = quantize(geometry.hatch_vertices, tolerance)
+    hatches = []
+    for i in range(geometry.hatch_count()):
+        ring_offsets = geometry.hatch_ring_offsets[geometry.hatch_polygon_offsets[i]:
+                                                   geometry.hatch_polygon_offsets[i + 1] + 1]
+        hatches.append(hashlib.sha1((ring_offsets - ring_offsets[0]).tobytes() +
+                                    hatch_vertex_keys[ring_offsets[0]:ring_offsets[-1]].tobytes()).digest())
+    digest.update(b'hatches')
+    digest.update(b''.join(sorted(hatches)))
+
+    return digest.hexdigest()
+
+
+class TestDeduplicateGeometry(unittest.TestCase):
+
+    def test_reversed_and_near_duplicate_lines(self):
+        geometry = LayerGeometry(lines=[(0, 0, 1, 1), (1, 1, 0, 0), (0, 0, 1 + 1e-8, 1), (0, 0, 2, 2)])
+        deduplicated = deduplicate_geometry(geometry)
+
+        self.assertEqual(len(deduplicated.lines), 2)
+        self.assertTrue(np.array_equal(deduplicated.lines, [(0, 0, 1, 1), (0, 0, 2, 2)]))
+
+    def test_circle_radii_are_merged(self):
+        geometry = LayerGeometry(circles=[(1, 1, 0.02), (1, 1, 0.02 + 1e-9), (2, 2, 0.02 + 1e-9), (3, 3, 0.05)])
+        deduplicated = deduplicate_geometry(geometry)
+
+        self.assertEqual(len(deduplicated.circles), 3)
+        self.assertEqual(len(np.unique(deduplicated.circles[:, 2])), 2)
+
+    def test_arcs(self):
+        geometry = LayerGeometry(arcs=[(0, 0, 1, 0, 90), (0, 0, 1, 360, 90), (0, 0, 1, 90, 0)])
+        deduplicated = deduplicate_geometry(geometry)
+
+        self.assertEqual(len(deduplicated.arcs), 2)
+
+    def test_polylines(self):
+        square = [(0, 0, 0, 0, 0), (1, 0, 0, 0, 0), (1, 1, 0, 0, 0)]
+        geometry = LayerGeometry(polyline_vertices=square * 2 + square[:2], polyline_offsets=[0, 3, 6, 8],
+                                 polyline_closed=[True, True, False])
+        deduplicated = deduplicate_geometry(geometry)
+
+        self.assertEqual(deduplicated.polyline_count(), 2)
+        self.assertTrue(np.array_equal(deduplicated.polyline_offsets, [0, 3, 5]))
+        self.assertTrue(np.array_equal(deduplicated.polyline_closed, [True, False]))
+
+    def test_unchanged_geometry_is_returned(self):
+        geometry = LayerGeometry(lines=[(0, 0, 1, 0)], circles=[(0, 0, 1)], arcs=[(0, 0, 1, 0, 90)])
+
+        self.assertIs(deduplicate_geometry(geometry), geometry)
+
+
+class TestGeometryDigest(unittest.TestCase):
+
+    def test_order_and_direction_do_not_change_digest(self):
+        geometry = LayerGeometry(lines=[(0, 0, 1, 0), (1, 0, 1, 1)], circles=[(0, 0, 0.1), (1, 1, 0.1)])
+        shuffled = LayerGeometry(lines=[(1, 1, 1, 0), (0, 0, 1 + 1e-9, 0)], circles=[(1, 1, 0.1), (0, 0, 0.1)])
+
+        self.assertEqual(geometry_digest(geometry), geometry_digest(shuffled))
+
+    def test_moved_trace_changes_digest(self):
+        geometry = LayerGeometry(lines=[(0, 0, 1, 0), (1, 0, 1, 1)])
+        moved = LayerGeometry(lines=[(0, 0, 1, 0), (1, 0, 1, 1.01)])
+
+        self.assertNotEqual(geometry_digest(geometry), geometry_digest(moved))
+        self.assertNotEqual(geometry_digest(LayerGeometry()), geometry_digest(LayerGeometry(circles=[(0, 0, 1)])))
+
+
+class TestGeometryStore(unittest.TestCase):
+
+    def test_layers_are_memory_mapped(self):
+        directory = tempfile.mkdtemp()
+        store = GeometryStore(directory)
+        geometry = LayerGeometry(lines=[(0, 0, 1, 0), (1, 0, 1, 1)], circles=[(0.5, 0.5, 0.1)],
+                                 polyline_vertices=[(0, 0, 0, 0, 0.5), (1, 0, 0, 0, 0)], polyline_offsets=[0, 2],
+                                 polyline_closed=[False])
+
+        stored = store.write("TOP", geometry)
+        # The arrays are views of the mapped files, not copies
+        base = stored.lines
+        while isinstance(base, np.ndarray):
+            base = base.base
+        self.assertIsInstance(base, mmap.mmap)
+        self.assertFalse(stored.lines.flags.writeable)
+        for name in GEOMETRY_ARRAYS:
+            self.assertTrue(np.array_equal(getattr(stored, name), getattr(geometry, name)))
+        self.assertEqual(geometry_digest(stored), geometry_digest(geometry))
+
+        # Writing a new revision keeps the maps of the previous one readable
+        store.write("TOP", LayerGeometry())
+        self.assertEqual(GeometryStore(directory).read("TOP").count(), 0)
+        self.assertEqual(len(stored.lines), 2)
+
+        store.remove("TOP")
+        self.assertEqual(GeometryStore(directory).layers(), [])
+        shutil.rmtree(directory)
+
+    def test_mapped_layers_are_pickled_by_path(self):
+        directory = tempfile.mkdtemp()
+        geometry = LayerGeometry(lines=np.zeros((100000, 4)))
+        geometry.get_index()
+
+        stored = GeometryStore(directory).write("TOP", geometry)
+        stored.get_index()
+        pickled = pickle.dumps(stored)
+        self.assertLess(len(pickled), 1000)
+        unpickled = pickle.loads(pickled)
+        self.assertEqual(unpickled.directory, stored.directory)
+        self.assertEqual(len(unpickled.lines), 100000)
+        self.assertIsNone(unpickled.index)
+
+        # Geometry held in memory is copied, but without its spatial index
+        self.assertIsNone(pickle.loads(pickle.dumps(geometry)).index)
+        self.assertIsNotNone(geometry.index)
+        shutil.rmtree(directory)
+
+
+class TestPolylines(unittest.TestCase):
+
+    def test_bulge_to_arcs(self):
+        # Half circles from (1, 0) to (-1, 0), counterclockwise through (0, 1) and clockwise through (0, -1)
+        start, end = np.array([(1.0, 0.0), (1.0, 0.0)]), np.array([(-1.0, 0.0), (-1.0, 0.0)])
+        bulge = np.array([1.0, -1.0])
+
+        self.assertTrue(np.allclose(bulge_to_arcs(start, end, bulge), [(0, 0, 1, 0, 180), (0, 0, 1, 180, 0)]))
+        self.assertTrue(np.allclose(bulge_midpoints(start, end, bulge), [(0, 1), (0, -1)]))
+
+    def test_polyline_segments(self):
+        geometry = LayerGeometry(polyline_vertices=[(0, 0, 0, 0, 0), (1, 0, 0, 0, 1), (1, 1, 0, 0, 0),
+                                                    (5, 5, 0, 0, 0), (6, 5, 0, 0, 0)],
+                                 polyline_offsets=[0, 3, 5], polyline_closed=[True, False])
+        starts, ends, bulges, polyline_ids = geometry.polyline_segments()
+
+        self.assertTrue(np.array_equal(polyline_ids, [0, 0, 0, 1]))
+        self.assertTrue(np.array_equal(ends, [(1, 0), (1, 1), (0, 0), (6, 5)]))
+        self.assertTrue(np.array_equal(bulges, [0, 1, 0, 0]))
+
+
+class TestHatches(unittest.TestCase):
+
+    def test_nest_rings(self):
+        def square(size):
+            return np.array([(-size, -size, 0), (size, -size, 0), (size, size, 0), (-size, size, 0)], dtype=float)
+
+        # Pour with a hole, and an island inside the hole
+        rings = [square(1), square(3), square(2)]
+
+        polygons = nest_rings(rings)
+        self.assertEqual([len(polygon) for polygon in polygons], [1, 2])
+        self.assertIs(polygons[1][0], rings[1])
+        self.assertIs(polygons[1][1], rings[2])
+
+        self.assertEqual([len(polygon) for polygon in nest_rings(rings, hatch_style=1)], [2])
+        self.assertEqual([len(polygon) for polygon in nest_rings(rings, hatch_style=2)], [1])
+
+    def test_select_hatches(self):
+        geometry = LayerGeometry(hatch_vertices=np.arange(30).reshape(10, 3), hatch_ring_offsets=[0, 3, 6, 10],
+                                 hatch_polygon_offsets=[0, 2, 3])
+        vertices, ring_offsets, polygon_offsets = geometry.select_hatches([1])
+
+        self.assertTrue(np.array_equal(vertices, geometry.hatch_vertices[6:]))
+        self.assertTrue(np.array_equal(ring_offsets, [0, 4]))
+        self.assertTrue(np.array_equal(polygon_offsets, [0, 1]))
+        self.assertEqual(len(geometry.hatch_rings(0)), 2)
+
+    def test_round_pads(self):
+        ezdxf = LazyModule("ezdxf")
+        doc = ezdxf.new()
+        # Round pad as a polyline path of two half circles
+        drawn = doc.modelspace().add_hatch()
+        drawn.paths.add_polyline_path([(1, 0, 1), (-1, 0, 1)], is_closed=True)
+        # Round pad as a single full circle arc edge
+        full_circle = doc.modelspace().add_hatch()
+        full_circle.paths.add_edge_path().add_arc((5, 0), 1, 0, 360)
+
+        polygons = extract_hatches([drawn, full_circle])['hatches']
+        self.assertEqual(len(polygons), 2)
+        for polygon, center in zip(polygons, [(0, 0), (5, 0)]):
+            ring = polygon[0]
+            self.assertEqual(ring.shape, (2, 3))
+            self.assertTrue(np.allclose(ring[:, 2], 1))
+            self.assertTrue(np.allclose(ring[:, :2].mean(axis=0), center))
+            self.assertTrue(np.allclose(np.hypot(*(ring[:, :2] - center).T), 1))
+
+        self.assertFalse(encloses_area(np.array([(0, 0, 0), (1, 0, 0)], dtype=float)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,14 @@
+import os
+import threading
+import traceback
+from functools import partial
+
 from kivy import Config
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.button import Button
+from kivy.uix.checkbox import CheckBox
 from kivy.uix.image import Image
 from kivy.uix.label import Label
 from kivy.uix.textinput import TextInput
@@ -10,12 +17,19 @@ from kivy.uix.popup import Popup
 from kivy.uix.screenmanager import ScreenManager
 
 
+from src import generatesteps, parsepcb
+from src.lazy import warm_up
 from src.parsepcb import ParsePCB
-from src.generatesteps import GenerateSteps
+from src.jobserver import UNIX_SOCKETS, submit_job
+from src.supervisor import generate_supervised
+from src.watch import WatchDXF
 
 # Import GUI configurations from gui.kv
 # Builder.load_file('src/gui.kv')
 
+# DXF files larger than this (bytes) are parsed out-of-core, see ParsePCB
+OUT_OF_CORE_FILE_SIZE = 100 * 1024 * 1024
+
 # Disable multi-touch emulation (right-click shows red dot on GUI)
 Config.set('input', 'mouse', 'mouse,multitouch_on_demand')
 
@@ -65,6 +79,17 @@ class GuiLayout(Widget):
                 Use the StackLayout defined in the .kv file to modify the values of the labels using the
                 string passed to the method. This effectively emulates a console.
 
+            run_in_background()
+                Run a long task (generating layers, processing a revision in watch mode) off the UI thread,
+                so that the window keeps responding, and hand its result back to the UI thread
+
+            generate_layers()
+                Generate the STEP files of the configured layers in a supervised process
+
+            toggle_watch()
+                Start or stop watching the DXF file. While watching, every saved revision of the file
+                re-renders and regenerates only the configured layers whose geometry changed.
+
             """
 
     def __init__(self, **kwargs):
@@ -92,6 +117,10 @@ class GuiLayout(Widget):
         self.selected_layers_to_entities = {}
         self.selected_layers_to_options = {}
 
+        self.watcher = None
+        self.watch_event = None
+        self.background_task = None
+
     def selected(self, filename):
 
         """
@@ -110,7 +139,9 @@ class GuiLayout(Widget):
                 self.ids.console_5.text = ""
                 self.print_to_console(f"[0] START: Loading {filename[0]}")
                 self.print_to_console("[1] PROCESS: Parsing file using ParsePCB")
-                self.parser = ParsePCB(filename[0])
+                # Large boards are parsed out-of-core, with their geometry in memory-mapped files
+                scratch_directory = 'etc/geometry' if os.path.getsize(filename[0]) > OUT_OF_CORE_FILE_SIZE else None
+                self.parser = ParsePCB(filename[0], scratch_directory=scratch_directory)
                 self.print_to_console(
                     f"[2] SUCCESS: Parsed {filename[0]}")
                 self.two = False
@@ -130,14 +161,12 @@ class GuiLayout(Widget):
 
     def get_configured_layers(self):
         selected_layers = self.layerPop.selected_layers
-        self.selected_layers_to_entities = self.layerPop.layer_to_entities
         self.selected_layers_to_options = self.layerPop.layer_to_options
 
-        all_layers = list(self.selected_layers_to_entities.keys())
-
-        for layer in all_layers:
-            if layer not in selected_layers:
-                self.selected_layers_to_entities.pop(layer)
+        # Pass the geometry arrays built at parse time, so the entities are not converted again
+        layer_to_geometry = self.parser.get_layer_geometry()
+        self.selected_layers_to_entities = {layer: geometry for layer, geometry in layer_to_geometry.items()
+                                            if layer in selected_layers}
 
         return self.selected_layers_to_entities, self.selected_layers_to_options
 
@@ -226,6 +255,18 @@ class GuiLayout(Widget):
                 conductive_trace_thickness_input.size_hint_y = 0.1
                 conductive_trace_thickness_input.height = 30
 
+            ######
+            job_server_box = BoxLayout(orientation="horizontal", size_hint_y=0.1)
+            job_server_label = Label(text="Submit to local job server")
+            with job_server_label.canvas:
+                job_server_label.font_size = 16
+                job_server_label.font_name = "imgs/font.otf"
+
+            job_server_checkbox = CheckBox(active=False, size_hint_x=0.2)
+            self.ids['submit_to_job_server'] = job_server_checkbox
+            job_server_box.add_widget(job_server_label)
+            job_server_box.add_widget(job_server_checkbox)
+
             button = Button(text="Generate STEP(s)")
             button.bind(on_press=self.generate_steps)
             with button.canvas:
@@ -244,6 +285,7 @@ class GuiLayout(Widget):
             vertical_box.add_widget(conductive_trace_width_input)
             vertical_box.add_widget(conductive_trace_thickness_label)
             vertical_box.add_widget(conductive_trace_thickness_input)
+            vertical_box.add_widget(job_server_box)
             vertical_box.add_widget(Widget(size_hint_y=0.1))
             vertical_box.add_widget(button)
 
@@ -306,9 +348,10 @@ class GuiLayout(Widget):
         if len(self.generate_step_parameters) == 5 and -1 not in self.generate_step_parameters:
             self.print_to_console("[4] SUCCESS: Parameters are loaded and generation of STEP files is starting")
             layer_to_entities, layer_to_options = self.get_configured_layers()
-            GenerateSteps(layer_to_entities, layer_to_options, self.generate_step_parameters[1],
-                          self.generate_step_parameters[2], self.generate_step_parameters[0],
-                          self.generate_step_parameters[3] * 0.005, self.generate_step_parameters[4])
+            if self.ids.submit_to_job_server.active:
+                self.submit_to_job_server(layer_to_options)
+            else:
+                self.generate_layers(layer_to_entities, layer_to_options)
             self.popup.dismiss()
 
 
@@ -327,6 +370,113 @@ class GuiLayout(Widget):
             self.print_to_console("[4] ERROR: Please enter all parameters")
         
 
+    def get_step_arguments(self):
+        return {"pcb_width": self.generate_step_parameters[1],
+                "pcb_height": self.generate_step_parameters[2],
+                "layer_thickness": self.generate_step_parameters[0],
+                "conductive_trace_width": self.generate_step_parameters[3] * 0.005,
+                "conductive_trace_thickness": self.generate_step_parameters[4]}
+
+    def run_in_background(self, task, finished):
+        """
+            Run task in a thread, and call finished with its result on the UI thread. Only one task runs at
+            a time. Returns False if another task is still running.
+        """
+        if self.background_task is not None and self.background_task.is_alive():
+            return False
+
+        def run():
+            try:
+                result = task()
+            except Exception as error:
+                traceback.print_exc()
+                message = f"[4] ERROR: {type(error).__name__}: {error}"
+                Clock.schedule_once(lambda dt: self.print_to_console(message))
+                return
+            Clock.schedule_once(lambda dt: finished(result))
+
+        self.background_task = threading.Thread(target=run, daemon=True)
+        self.background_task.start()
+        return True
+
+    def generate_layers(self, layer_to_geometry, layer_to_options):
+        """
+            Generate the layers in a supervised process, so that a layer that hangs or crashes OCC does not
+            take the GUI down, and plane layers share the drilled plane. A layer that fails is written without
+            the primitives that make it fail.
+        """
+        task = partial(generate_supervised, layer_to_geometry, dict(layer_to_options), self.get_step_arguments())
+        if not self.run_in_background(task, self.report_layers):
+            self.print_to_console("[4] ERROR: STEP files are already being generated, wait for them to finish")
+
+    def report_layers(self, reports):
+        for report in reports:
+            if report["status"] == "done":
+                self.print_to_console(f"[4] SUCCESS: Wrote {report['layer'].lower()}.step")
+            elif report["status"] == "partial":
+                self.print_to_console(f"[4] INFO: Wrote {report['layer'].lower()}.step without "
+                                      f"{len(report['culprits'])} primitive(s) that failed, see the terminal")
+                print(f"{report['layer']}: {report['message']}")
+            else:
+                self.print_to_console(f"[4] ERROR: Could not generate {report['layer']}: {report['message']}")
+
+    def submit_to_job_server(self, layer_to_options):
+        """
+            Queue the conversion on the local job server instead of running it in the GUI process.
+            The STEP files are written to the STEP_files directory of the working directory, as they
+            would be by GenerateSteps. Without Unix sockets, the server writes them to the job's directory.
+        """
+        try:
+            job_id, deduplicated = submit_job(self.parser.dxf_file_name, dict(layer_to_options),
+                                              self.get_step_arguments(),
+                                              output_directory=os.getcwd() if UNIX_SOCKETS else None)
+        except ValueError as error:
+            self.print_to_console(f"[4] ERROR: The job server refused the job: {error}")
+            return
+        except OSError:
+            self.print_to_console("[4] ERROR: Could not reach the job server, start it with python -m src.jobserver")
+            return
+
+        if deduplicated:
+            self.print_to_console(f"[4] INFO: An identical conversion is already in progress (job {job_id})")
+        else:
+            self.print_to_console(f"[4] SUCCESS: Submitted job {job_id} to the job server")
+
+    def toggle_watch(self):
+        if self.watcher is not None:
+            self.watch_event.cancel()
+            self.watcher = None
+            self.ids.watch_button.text = "4)     Watch DXF"
+            self.print_to_console("[5] INFO: Stopped watching the DXF file")
+        elif self.parser is None:
+            self.print_to_console("[0] ERROR: No DXF File Selected")
+        elif not self.two or -1 in self.generate_step_parameters:
+            self.print_to_console("[5] ERROR: Configure layers and generate STEP(s) once before watching")
+        else:
+            _, layer_to_options = self.get_configured_layers()
+            self.watcher = WatchDXF(self.parser.dxf_file_name, dict(layer_to_options), self.get_step_arguments(),
+                                    parser=self.parser)
+            self.watch_event = Clock.schedule_interval(self.poll_watcher, self.watcher.interval)
+            self.ids.watch_button.text = "4)     Stop watching"
+            self.print_to_console(f"[5] INFO: Watching {self.parser.dxf_file_name} for changes")
+
+    def poll_watcher(self, dt):
+        # Revisions are parsed and generated in the background, polls are skipped while that is running
+        self.run_in_background(self.watcher.poll, self.watcher_polled)
+
+    def watcher_polled(self, changed_layers):
+        if changed_layers is None:
+            return
+
+        if not changed_layers:
+            self.print_to_console("[5] INFO: DXF file was saved, but no layer changed")
+            return
+        self.print_to_console(f"[5] SUCCESS: Updated layers {stringify_entity_list(sorted(changed_layers))}")
+
+        # Kivy caches images by file name, so reload the previews that were rendered again
+        if self.two:
+            self.layerPop.refresh_layers(changed_layers)
+
     def layer_sel(self):
         if self.parser is not None and self.two is False:
             self.layerPop = LayerPop(self, title='Select Layers')
@@ -358,7 +508,6 @@ class LayerPop(Popup):
         self.current_layer = ""
         self.selected_layers = []
         self.discarded_layers = []
-        self.layer_to_entities = {}
         self.layer_to_options = {}
         _, self.rendered_layers = self.parser.get_layer_names()
         self.ids.spin_id.values = self.rendered_layers
@@ -368,7 +517,6 @@ class LayerPop(Popup):
         self.ids.pic.add_widget(self.img)
         self.layer_to_unique_entities, self.layer_to_overlooked_entities = \
             self.parser.get_layer_to_entity_types()
-        self.layer_to_entities = self.parser.get_layer_entities()
         self.ids.spin_id.background_color = (113 / 255, 149 / 255, 222 / 255, 1)
 
         self.layer_buttons_show = False
@@ -380,6 +528,20 @@ class LayerPop(Popup):
     def cancel(self):
         self.dismiss()
 
+    def refresh_layers(self, changed_layers):
+        """
+            Called in watch mode after the DXF file was parsed again. Updates the entity types of the
+            layers, and reloads the image on display if its layer (or the PCB layout) was rendered again.
+        """
+        _, self.rendered_layers = self.parser.get_layer_names()
+        self.layer_to_unique_entities, self.layer_to_overlooked_entities = \
+            self.parser.get_layer_to_entity_types()
+        self.ids.spin_id.values = [layer for layer in self.rendered_layers
+                                   if layer not in self.selected_layers and layer not in self.discarded_layers]
+
+        if self.current_layer in changed_layers or self.current_layer in ("", "PCB Layout"):
+            self.img.reload()
+
     def layer_options_clicked(self, value):
         if self.current_layer:
             self.layer_options_val = value
@@ -500,6 +662,10 @@ class GuiApp(App):
         -------
         build()
             Build the layout
+
+        on_start()
+            Once the window is shown, import ezdxf, its drawing add-on, and CadQuery in the background,
+            so that they are ready by the time a file is selected
     """
 
     def build(self):
@@ -507,6 +673,9 @@ class GuiApp(App):
 
         return GuiLayout()
 
+    def on_start(self):
+        warm_up(parsepcb.ezdxf, parsepcb.matplotlib, generatesteps.cq)
+
 # TODO: Button to finish if all layers are discarded and proceed (explain in console if for example indexes are messed up)
 # TODO: Button generate opens popup with options for thickness and stuff. drag slide bar
 # TODO: add unit tests for this class
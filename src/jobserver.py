@@ -0,0 +1,896 @@
+import argparse
+import contextlib
+import hashlib
+import http.client
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import socket
+import socketserver
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import unittest
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from src import costmodel
+from src.costmodel import CostModel, layer_features, next_job
+from src.drillmap import DRILL_ONLY, DrillMap
+from src.generatesteps import create_output_directory, step_file_name
+from src.geometry import read_geometry_directory
+from src.supervisor import DEFAULT_TIMEOUT, LayerSupervisor
+from src.parsepcb import ParsePCB, ezdxf
+
+DEFAULT_PORT = 8765
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".pcb_step_jobs")
+
+# Jobs are accepted on a Unix socket that only the user running the server can connect to. Where Unix sockets
+# are not available, the server listens on the loopback interface instead, and then writes every job to its
+# own directory, since any local user can reach it.
+UNIX_SOCKETS = hasattr(socket, "AF_UNIX")
+DEFAULT_ADDRESS = os.path.join(DEFAULT_DIRECTORY, "jobs.sock") if UNIX_SOCKETS else f"127.0.0.1:{DEFAULT_PORT}"
+
+# Jobs that are queued or running are in flight, identical submissions are merged into them
+IN_FLIGHT = ("queued", "running")
+
+# A task is stopped once it uses this many times its predicted memory, or MIN_MEMORY_LIMIT bytes if that is more.
+# Tasks are admitted by these limits, so running tasks cannot use more than the memory budget together.
+MEMORY_LIMIT_FACTOR = 2
+MIN_MEMORY_LIMIT = 1e9
+
+
+def content_hash(request):
+    """
+        SHA-256 of the bytes of the DXF file and of the job parameters, so that two submissions of the
+        same revision with the same options share a hash, whatever the file is called
+    """
+    digest = hashlib.sha256()
+    with open(request["dxf_file"], "rb") as dxf_file:
+        for chunk in iter(lambda: dxf_file.read(1 << 20), b""):
+            digest.update(chunk)
+    digest.update(json.dumps({key: value for key, value in request.items() if key != "dxf_file"},
+                             sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class JobQueue:
+    """
+        JobQueue persists conversion jobs in a SQLite database, so queued jobs survive a restart of the
+        server. Every method opens its own connection, which lets the server threads and the worker
+        processes share the database.
+
+        Attributes
+        ----------
+        database : str
+            Path of the SQLite database file
+
+        Methods
+        -------
+        submit()
+            Queue a job, or return the in-flight job with the same content hash
+
+        claim()
+            Mark the oldest queued job as running and return it
+
+        update()
+            Set the status, progress, or message of a job
+
+        add_tasks()
+            Split a claimed job into layer tasks
+
+        retry_task()
+            Queue a task again with a new memory prediction
+
+        finish_task()
+            Record the outcome of a layer task, and finish its job once all of its tasks are finished
+
+        requeue_interrupted()
+            Queue again the jobs and tasks that were running when the server stopped
+    """
+
+    def __init__(self, database):
+        self.database = database
+        with self.connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                               "id TEXT PRIMARY KEY, content_hash TEXT NOT NULL, status TEXT NOT NULL, "
+                               "progress REAL NOT NULL DEFAULT 0, message TEXT NOT NULL DEFAULT '', "
+                               "request TEXT NOT NULL, submitted REAL NOT NULL, started REAL, finished REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, submitted)")
+            connection.execute("CREATE TABLE IF NOT EXISTS tasks ("
+                               "id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL, layer TEXT NOT NULL, "
+                               "status TEXT NOT NULL, message TEXT NOT NULL DEFAULT '', geometry_path TEXT, "
+                               "features TEXT, predicted_seconds REAL NOT NULL DEFAULT 0, "
+                               "predicted_memory REAL NOT NULL DEFAULT 0, seconds REAL, memory REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS tasks_by_job ON tasks (job_id)")
+
+    @contextlib.contextmanager
+    def connect(self):
+        # Autocommit mode, transactions are opened explicitly where several statements must be atomic
+        connection = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def submit(self, request):
+        """
+            Returns the job id, and whether the request was merged into an identical in-flight job
+        """
+        job_hash = content_hash(request)
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT id FROM jobs WHERE content_hash = ? AND status IN (?, ?)",
+                                     (job_hash, *IN_FLIGHT)).fetchone()
+            if row is not None:
+                connection.execute("COMMIT")
+                return row["id"], True
+
+            job_id = uuid.uuid4().hex
+            connection.execute("INSERT INTO jobs (id, content_hash, status, request, submitted) "
+                               "VALUES (?, ?, 'queued', ?, ?)", (job_id, job_hash, json.dumps(request), time.time()))
+            connection.execute("COMMIT")
+            return job_id, False
+
+    def claim(self):
+        """
+            Returns the id and request of the oldest queued job after marking it as running,
+            or None if no job is queued
+        """
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT id, request FROM jobs WHERE status = 'queued' "
+                                     "ORDER BY submitted LIMIT 1").fetchone()
+            if row is not None:
+                connection.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?",
+                                   (time.time(), row["id"]))
+            connection.execute("COMMIT")
+
+        if row is None:
+            return None
+        return row["id"], json.loads(row["request"])
+
+    def update(self, job_id, **fields):
+        with self.connect() as connection:
+            connection.execute(f"UPDATE jobs SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+                               (*fields.values(), job_id))
+
+    def finish(self, job_id, status, message):
+        self.update(job_id, status=status, message=message, finished=time.time(),
+                    **({"progress": 1.0} if status == "done" else {}))
+
+    def add_tasks(self, job_id, tasks):
+        """
+            Store the layer tasks of a job, given as dictionaries of task columns. Returns the final status
+            of the job if none of its tasks needs to run, otherwise None.
+        """
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            for task in tasks:
+                task = dict(task, job_id=job_id)
+                if "features" in task:
+                    task["features"] = json.dumps(task["features"])
+                connection.execute(f"INSERT INTO tasks ({', '.join(task)}) VALUES ({', '.join('?' * len(task))})",
+                                   tuple(task.values()))
+            connection.execute("COMMIT")
+
+        return self.update_job_progress(job_id)
+
+    def queued_tasks(self):
+        """
+            Queued tasks, each with the request of its job
+        """
+        with self.connect() as connection:
+            rows = connection.execute("SELECT tasks.*, jobs.request AS request FROM tasks "
+                                      "JOIN jobs ON jobs.id = tasks.job_id WHERE tasks.status = 'queued'").fetchall()
+
+        tasks = [dict(row) for row in rows]
+        for task in tasks:
+            task["request"] = json.loads(task["request"])
+            task["features"] = json.loads(task["features"])
+        return tasks
+
+    def start_task(self, task_id):
+        with self.connect() as connection:
+            connection.execute("UPDATE tasks SET status = 'running' WHERE id = ?", (task_id,))
+
+    def retry_task(self, task_id, predicted_memory, message):
+        with self.connect() as connection:
+            connection.execute("UPDATE tasks SET status = 'queued', predicted_memory = ?, message = ? WHERE id = ?",
+                               (predicted_memory, message, task_id))
+
+    def finish_task(self, task_id, status, message, seconds=None, memory=None):
+        """
+            Returns the final status of the task's job if this was its last task, otherwise None
+        """
+        with self.connect() as connection:
+            connection.execute("UPDATE tasks SET status = ?, message = ?, seconds = ?, memory = ? WHERE id = ?",
+                               (status, message, seconds, memory, task_id))
+            job_id = connection.execute("SELECT job_id FROM tasks WHERE id = ?", (task_id,)).fetchone()["job_id"]
+
+        return self.update_job_progress(job_id)
+
+    def update_job_progress(self, job_id):
+        with self.connect() as connection:
+            tasks = connection.execute("SELECT layer, status, message, predicted_seconds FROM tasks "
+                                       "WHERE job_id = ?", (job_id,)).fetchall()
+            request = json.loads(connection.execute("SELECT request FROM jobs WHERE id = ?",
+                                                    (job_id,)).fetchone()["request"])
+
+        finished = [task for task in tasks if task["status"] in ("done", "partial", "failed")]
+        if len(finished) < len(tasks):
+            # Progress is weighted by the predicted time of the tasks
+            total = sum(task["predicted_seconds"] for task in tasks)
+            progress = sum(task["predicted_seconds"] for task in finished) / total if total > 0 else 0
+            self.update(job_id, progress=progress, message=f"{len(finished)} of {len(tasks)} layer(s) finished")
+            return None
+
+        failed = [task for task in tasks if task["status"] == "failed"]
+        done = len(tasks) - len(failed)
+        output_directory = job_output_directory(os.path.dirname(self.database), job_id, request)
+        message = f"Wrote {done} STEP file(s) to {os.path.join(output_directory, 'STEP_files')}"
+        partial = [task for task in tasks if task["status"] == "partial"]
+        if partial:
+            message += "; incomplete: " + ", ".join(f"{task['layer']} ({task['message']})" for task in partial)
+        if failed:
+            message += "; failed: " + ", ".join(f"{task['layer']} ({task['message']})" for task in failed)
+        status = "failed" if failed or not tasks else "done"
+        self.finish(job_id, status, message)
+        return status
+
+    def requeue_interrupted(self):
+        with self.connect() as connection:
+            connection.execute("UPDATE tasks SET status = 'queued' WHERE status = 'running'")
+            # Jobs that were split into tasks resume with their queued tasks, the others are planned again
+            connection.execute("UPDATE jobs SET status = 'queued', progress = 0, started = NULL "
+                               "WHERE status = 'running' AND id NOT IN (SELECT job_id FROM tasks)")
+
+    def get(self, job_id):
+        with self.connect() as connection:
+            row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            tasks = connection.execute("SELECT layer, status, message, predicted_seconds, predicted_memory, "
+                                       "seconds, memory FROM tasks WHERE job_id = ? ORDER BY id",
+                                       (job_id,)).fetchall()
+
+        job = job_to_dict(row)
+        job["tasks"] = [dict(task) for task in tasks]
+        return job
+
+    def jobs(self):
+        with self.connect() as connection:
+            return [job_to_dict(row) for row in connection.execute("SELECT * FROM jobs ORDER BY submitted")]
+
+
+def job_to_dict(row):
+    job = dict(row)
+    job["request"] = json.loads(job["request"])
+    return job
+
+
+def job_output_directory(directory, job_id, request):
+    """
+        Jobs without an output directory get their own, next to the job database
+    """
+    return request.get("output_directory") or os.path.join(directory, job_id)
+
+
+def socket_path(directory):
+    return os.path.join(directory, "jobs.sock")
+
+
+def drill_map_path(directory, job_id):
+    """
+        The drill map of a job is collected from all its layers once, and shared by its layer tasks
+    """
+    return os.path.join(directory, "scratch", job_id, "drill_map.npy")
+
+
+def run_layer_task(geometry_path, drill_map_path, layer, layer_to_options, step_arguments, output_directory,
+                   timeout=DEFAULT_TIMEOUT, memory_limit=None, predicted_seconds=None):
+    """
+        Generate the STEP file of one layer from a worker process. The layer itself runs under a LayerSupervisor,
+        so a layer that hangs or crashes OCC does not take the worker pool down. Returns the supervisor's report.
+    """
+    supervisor = LayerSupervisor(layer_to_options, step_arguments, DrillMap.load(drill_map_path), output_directory,
+                                 timeout, memory_limit)
+    return supervisor.run(layer, read_geometry_directory(geometry_path), predicted_seconds)
+
+
+class JobServer:
+    """
+        JobServer accepts conversion jobs over HTTP on a Unix socket, stores them in a JobQueue,
+        and runs them on a bounded pool of worker processes. One server is shared by all the users of a
+        workstation, so conversions are scheduled together instead of competing for the machine.
+
+        Every job is split into one task per layer. A CostModel predicts the time and peak memory of each
+        task from the layer's geometry, tasks start longest first, and a task only starts when its
+        predicted memory fits in the memory budget next to the running tasks. Shorter tasks are held
+        back while the longest one waits for memory.
+
+        Attributes
+        ----------
+        directory : str
+            Directory of the job database, the cost model, the socket, and the memory-mapped geometry handed
+            to workers. A directory created by the server is private to its user, an existing one keeps its
+            permissions. Jobs submitted without an output directory write their STEP files to a directory
+            named after the job id in it.
+
+        workers : int
+            Number of tasks run at the same time (defaults to the number of CPUs)
+
+        port : int
+            Listen on this loopback port instead of the Unix socket (the default where Unix sockets are not
+            available). Any local user can submit jobs on it, so their output directories are not accepted.
+
+        memory_budget : float
+            Memory (bytes) that running tasks may use together (defaults to 75% of the RAM). Every task gets
+            a memory limit from its predicted memory, see task_memory_limit(), and is stopped if it uses
+            more. A task stopped by a limit below the budget is queued again to run alone with the whole budget.
+
+        task_timeout : float
+            Seconds a task may run before it is stopped, or ten times its predicted time if that is longer.
+            Stopped tasks fail. Only tasks where OCC raises or crashes are bisected, to write the layer without
+            the primitives that fail it.
+
+        Methods
+        -------
+        submit()
+            Queue a job and wake up the planner
+
+        plan_jobs()
+            Parse the files of queued jobs, and queue a task with its predicted cost for every layer. Runs on a
+            planning thread of its own, so that parsing a large board does not hold up dispatching.
+
+        dispatch_tasks()
+            Start queued tasks, longest first, while workers are free and memory is available
+
+        task_memory_limit()
+            Memory a task may use before it is stopped
+
+        serve_forever()
+            Serve HTTP requests and schedule jobs until interrupted
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, workers=None, port=None, memory_budget=None,
+                 task_timeout=DEFAULT_TIMEOUT):
+        self.directory = directory
+        # Only a directory created here is made private, an existing one (e.g. a shared directory) is left as it is
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+            os.chmod(self.directory, 0o700)
+        self.queue = JobQueue(os.path.join(self.directory, "jobs.sqlite"))
+        self.queue.requeue_interrupted()
+        self.cost_model = CostModel(os.path.join(self.directory, "cost_model.json"))
+
+        self.workers = workers or os.cpu_count()
+        self.memory_budget = memory_budget if memory_budget is not None else costmodel.memory_budget()
+        self.task_timeout = task_timeout
+        self.pool = self.create_pool()
+
+        # Dictionary of running task ids to their memory limit
+        self.running = {}
+        self.lock = threading.Lock()
+        # Set when tasks may be dispatched, and when jobs were submitted
+        self.wake_up = threading.Event()
+        self.jobs_submitted = threading.Event()
+        self.stopped = False
+
+        if port is None and UNIX_SOCKETS:
+            self.http_server = UnixHTTPServer(socket_path(self.directory), JobRequestHandler)
+            self.address = self.http_server.server_address
+        else:
+            self.http_server = ThreadingHTTPServer(("127.0.0.1", DEFAULT_PORT if port is None else port),
+                                                   JobRequestHandler)
+            self.address = f"127.0.0.1:{self.http_server.server_port}"
+        self.http_server.job_server = self
+
+    def create_pool(self):
+        # Spawned workers start without the server's threads. Where supported, every task gets a fresh worker,
+        # which returns its memory to the system.
+        if sys.version_info >= (3, 11):
+            return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                       max_tasks_per_child=1)
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self, request):
+        request = dict(request)
+        request["dxf_file"] = os.path.abspath(request["dxf_file"])
+        if request.get("output_directory") and isinstance(self.http_server, ThreadingHTTPServer):
+            raise ValueError("output_directory is only accepted on the job server's Unix socket")
+
+        job_id, deduplicated = self.queue.submit(request)
+        self.jobs_submitted.set()
+        return job_id, deduplicated
+
+    def plan_jobs(self):
+        while True:
+            job = self.queue.claim()
+            if job is None:
+                break
+            job_id, request = job
+
+            scratch_directory = os.path.join(self.directory, "scratch", job_id)
+            try:
+                self.plan_job(job_id, request, scratch_directory)
+                # The tasks of the job can be dispatched while the next job is planned
+                self.wake_up.set()
+            except IOError as error:
+                self.queue.finish(job_id, "failed", str(error))
+                shutil.rmtree(scratch_directory, ignore_errors=True)
+            except Exception as error:
+                # A job that cannot be planned must not stay running forever, nor stop the scheduler
+                traceback.print_exc()
+                self.queue.finish(job_id, "failed", f"{type(error).__name__}: {error}")
+                shutil.rmtree(scratch_directory, ignore_errors=True)
+
+    def plan_job(self, job_id, request, scratch_directory):
+        # Layers are handed to the workers as memory-mapped geometry arrays, so that the file is only
+        # parsed once, and the parsed board is not kept in the server's memory
+        parser = ParsePCB(request["dxf_file"], render=False, scratch_directory=scratch_directory)
+        layer_to_geometry = parser.get_layer_geometry()
+        drill_layers = [layer for layer, option in request["layer_to_options"].items() if option == DRILL_ONLY]
+        drill_map = DrillMap.from_layers(layer_to_geometry, drill_layers or request["layer_to_options"].keys())
+        drill_map.save(drill_map_path(self.directory, job_id))
+        # Every plane is drilled with the holes of the whole board that lie on it
+        holes = len(drill_map.on_board(request["step_arguments"]["pcb_width"],
+                                       request["step_arguments"]["pcb_height"]))
+
+        create_output_directory(directory=os.path.join(job_output_directory(self.directory, job_id, request),
+                                                       "STEP_files"))
+
+        tasks = []
+        for layer, option in request["layer_to_options"].items():
+            if layer not in layer_to_geometry:
+                tasks.append({"layer": layer, "status": "failed", "message": "Layer not found in the DXF file"})
+                continue
+            if option == DRILL_ONLY:
+                continue
+
+            features = layer_features(layer_to_geometry[layer], option, holes)
+            seconds, memory = self.cost_model.predict(features)
+            tasks.append({"layer": layer, "status": "queued",
+                          "geometry_path": parser.geometry_store.layer_path(layer),
+                          "features": features.tolist(), "predicted_seconds": seconds,
+                          "predicted_memory": memory})
+
+        if self.queue.add_tasks(job_id, tasks) is not None:
+            shutil.rmtree(scratch_directory, ignore_errors=True)
+
+    def dispatch_tasks(self):
+        with self.lock:
+            queued = [(task, task["predicted_seconds"], self.task_memory_limit(task))
+                      for task in self.queue.queued_tasks()]
+            while len(self.running) < self.workers and queued:
+                task = next_job(queued, sum(self.running.values()), self.memory_budget)
+                if task is None:
+                    break
+                queued = [queued_task for queued_task in queued if queued_task[0] is not task]
+                memory_limit = self.task_memory_limit(task)
+
+                request = task["request"]
+                try:
+                    future = self.pool.submit(run_layer_task, task["geometry_path"],
+                                              drill_map_path(self.directory, task["job_id"]), task["layer"],
+                                              request["layer_to_options"], request["step_arguments"],
+                                              job_output_directory(self.directory, task["job_id"], request),
+                                              max(self.task_timeout, 10 * task["predicted_seconds"]),
+                                              memory_limit if math.isfinite(memory_limit) else None,
+                                              task["predicted_seconds"])
+                except BrokenProcessPool:
+                    # A worker died and took the pool down, start a new pool and try again later
+                    self.pool = self.create_pool()
+                    break
+
+                self.queue.start_task(task["id"])
+                self.running[task["id"]] = memory_limit
+                future.add_done_callback(partial(self.task_finished, task))
+
+    def task_memory_limit(self, task):
+        return min(self.memory_budget, max(MEMORY_LIMIT_FACTOR * task["predicted_memory"], MIN_MEMORY_LIMIT))
+
+    def task_finished(self, task, future):
+        error = future.exception()
+        with self.lock:
+            memory_limit = self.running.pop(task["id"])
+            report = future.result() if error is None else None
+            # Only layers that ran in one piece measure the cost of the whole layer
+            if report is not None and report["status"] == "done":
+                self.cost_model.record(np.array(task["features"]), report["seconds"], report["memory"])
+                self.cost_model.save()
+
+        if report is not None and report["limit"] == "memory" and memory_limit < self.memory_budget:
+            # The prediction was too low, the task runs again once it can have the whole budget
+            self.queue.retry_task(task["id"], self.memory_budget, report["message"])
+            job_status = None
+        elif report is not None:
+            job_status = self.queue.finish_task(task["id"], report["status"], report["message"], report["seconds"],
+                                                report["memory"])
+        elif isinstance(error, BrokenProcessPool):
+            job_status = self.queue.finish_task(task["id"], "failed", "Worker process exited unexpectedly")
+        else:
+            job_status = self.queue.finish_task(task["id"], "failed", f"{type(error).__name__}: {error}")
+
+        if job_status is not None:
+            shutil.rmtree(os.path.join(self.directory, "scratch", task["job_id"]), ignore_errors=True)
+        self.wake_up.set()
+
+    def planner_loop(self):
+        while not self.stopped:
+            try:
+                self.plan_jobs()
+            except Exception:
+                # e.g. the database is locked, planning is tried again on the next wake up
+                print("Planning failed, retrying")
+                traceback.print_exc()
+            self.jobs_submitted.wait(timeout=1)
+            self.jobs_submitted.clear()
+
+    def scheduler_loop(self):
+        while not self.stopped:
+            try:
+                self.dispatch_tasks()
+            except Exception:
+                print("Scheduling failed, retrying")
+                traceback.print_exc()
+            self.wake_up.wait(timeout=1)
+            self.wake_up.clear()
+
+    def serve_forever(self):
+        for loop in (self.planner_loop, self.scheduler_loop):
+            threading.Thread(target=loop, daemon=True).start()
+        print(f"Serving conversion jobs on {self.address} with {self.workers} worker(s)")
+        try:
+            self.http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopped = True
+            self.http_server.server_close()
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+# UnixStreamServer only exists where Unix sockets do, the server is not used elsewhere
+class UnixHTTPServer(socketserver.ThreadingMixIn, getattr(socketserver, "UnixStreamServer", socketserver.TCPServer)):
+    """
+        HTTP server on a Unix socket that only its owner can connect to. A socket left behind by a server
+        that did not stop cleanly is replaced, but not the socket of a server that is still running.
+    """
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(self.server_address)
+                except OSError:
+                    os.remove(self.server_address)
+                else:
+                    raise OSError(f"A job server is already running on {self.server_address}")
+        # The socket is created with owner-only permissions, so it is never reachable by others, even briefly.
+        # The umask is process-wide, but the server binds before any of its threads start.
+        previous_umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(previous_umask)
+
+    def server_close(self):
+        super().server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.server_address)
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+        POST /jobs queues a job, GET /jobs lists all jobs, and GET /jobs/<id> returns the status of a job
+    """
+
+    def do_GET(self):
+        queue = self.server.job_server.queue
+        if self.path == "/jobs":
+            self.send_json(200, queue.jobs())
+        elif self.path.startswith("/jobs/") and queue.get(self.path[len("/jobs/"):]) is not None:
+            self.send_json(200, queue.get(self.path[len("/jobs/"):]))
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self.send_json(404, {"error": "Not found"})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if not os.path.isfile(request["dxf_file"]):
+                raise ValueError(f"{request['dxf_file']} does not exist")
+            if not isinstance(request["layer_to_options"], dict) or not isinstance(request["step_arguments"], dict):
+                raise ValueError("layer_to_options and step_arguments must be objects")
+        except (ValueError, KeyError, TypeError) as error:
+            self.send_json(400, {"error": f"Invalid job: {error}"})
+            return
+
+        try:
+            job_id, deduplicated = self.server.job_server.submit(request)
+        except ValueError as error:
+            self.send_json(403, {"error": str(error)})
+            return
+        self.send_json(202, {"id": job_id, "deduplicated": deduplicated})
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+        HTTP connection to a server listening on a Unix socket
+    """
+
+    def __init__(self, path, timeout=10):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request_json(method, path, body=None, address=DEFAULT_ADDRESS):
+    """
+        Send a request to the job server at address, a socket path or a host:port, and return the decoded
+        response. Raises OSError if no server is running, and ValueError if the server refused the request.
+    """
+    host, _, port = address.rpartition(":")
+    if port.isdigit() and os.sep not in address:
+        connection = http.client.HTTPConnection(host, int(port), timeout=10)
+    else:
+        connection = UnixHTTPConnection(address)
+
+    try:
+        connection.request(method, path, body=None if body is None else json.dumps(body).encode(),
+                           headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        content = json.loads(response.read())
+    finally:
+        connection.close()
+
+    if response.status >= 400:
+        raise ValueError(content.get("error", f"HTTP {response.status}"))
+    return content
+
+
+def submit_job(dxf_file, layer_to_options, step_arguments, output_directory=None, address=DEFAULT_ADDRESS):
+    """
+        Submit a conversion to a running job server. Returns the job id, and whether the job was merged into
+        an identical job already in flight. Raises OSError if no server is running.
+    """
+    request = {"dxf_file": os.path.abspath(dxf_file), "layer_to_options": layer_to_options,
+               "step_arguments": step_arguments}
+    if output_directory is not None:
+        request["output_directory"] = os.path.abspath(output_directory)
+
+    body = request_json("POST", "/jobs", request, address)
+    return body["id"], body["deduplicated"]
+
+
+def get_job(job_id, address=DEFAULT_ADDRESS):
+    return request_json("GET", f"/jobs/{job_id}", address=address)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Run the local job server that converts DXF files to STEP files")
+    parser.add_argument("--directory", default=DEFAULT_DIRECTORY, help="directory of the job database")
+    parser.add_argument("--workers", type=int, default=None, help="number of conversions run at the same time")
+    parser.add_argument("--port", type=int, default=None,
+                        help="listen on this loopback port instead of a Unix socket (jobs then write their STEP "
+                             "files to the job directory)")
+    parser.add_argument("--memory-budget", type=float, default=None,
+                        help="predicted memory that running conversions may use together (GB), "
+                             "defaults to 75%% of the RAM")
+    parser.add_argument("--task-timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="seconds a layer may run before it is stopped (stopped layers fail, only layers where OCC "
+                             "raises or crashes are bisected)")
+    arguments = parser.parse_args(arguments)
+
+    memory_budget = arguments.memory_budget * 1e9 if arguments.memory_budget is not None else None
+    JobServer(arguments.directory, arguments.workers, arguments.port, memory_budget,
+              arguments.task_timeout).serve_forever()
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dxf_file = os.path.join(self.directory, "board.dxf")
+        doc = ezdxf.new()
+        doc.modelspace().add_line((0.1, 0.1), (0.9, 0.1), dxfattribs={"layer": "TOP"})
+        doc.saveas(self.dxf_file)
+
+        self.queue = JobQueue(os.path.join(self.directory, "jobs.sqlite"))
+        self.request = {"dxf_file": self.dxf_file, "layer_to_options": {"TOP": "Conductive Traces only"},
+                        "step_arguments": {"pcb_width": 1, "pcb_height": 1, "layer_thickness": 0.04,
+                                           "conductive_trace_width": 0.00005, "conductive_trace_thickness": 0.01},
+                        "output_directory": self.directory}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_identical_in_flight_jobs_are_merged(self):
+        job_id, deduplicated = self.queue.submit(self.request)
+        self.assertFalse(deduplicated)
+        self.assertEqual(self.queue.submit(dict(self.request)), (job_id, True))
+
+        # Different options make a different job
+        other_request = dict(self.request, layer_to_options={"TOP": "Conductive Traces AND Vias AND Plane"})
+        self.assertNotEqual(self.queue.submit(other_request)[0], job_id)
+
+        # Once the job is done, the same request is converted again
+        self.assertEqual(self.queue.claim()[0], job_id)
+        self.queue.finish(job_id, "done", "")
+        self.assertNotEqual(self.queue.submit(self.request), (job_id, True))
+
+    def test_interrupted_jobs_are_queued_again(self):
+        job_id, _ = self.queue.submit(self.request)
+        self.queue.claim()
+        self.assertIsNone(self.queue.claim())
+
+        JobQueue(self.queue.database).requeue_interrupted()
+        self.assertEqual(self.queue.get(job_id)["status"], "queued")
+
+    def test_layer_tasks(self):
+        server = JobServer(self.directory, workers=1)
+        request = dict(self.request, layer_to_options={"TOP": "Conductive Traces only",
+                                                       "MISSING": "Conductive Traces only"})
+        job_id, _ = server.submit(request)
+        server.plan_jobs()
+
+        tasks = server.queue.queued_tasks()
+        self.assertEqual([task["layer"] for task in tasks], ["TOP"])
+        self.assertGreater(tasks[0]["predicted_seconds"], 0)
+
+        # The layer is generated in a process of its own, which changes to the output directory
+        report = run_layer_task(tasks[0]["geometry_path"], drill_map_path(self.directory, job_id), "TOP",
+                                request["layer_to_options"], request["step_arguments"], self.directory)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, step_file_name("TOP"))))
+
+        # The missing layer fails the job, but the other layer is still converted
+        self.assertEqual(report["status"], "done")
+        self.assertEqual(server.queue.finish_task(tasks[0]["id"], "done", "", report["seconds"], report["memory"]),
+                         "failed")
+        job = server.queue.get(job_id)
+        self.assertEqual([task["status"] for task in job["tasks"]], ["done", "failed"])
+        self.assertIn("MISSING", job["message"])
+        server.http_server.server_close()
+
+    def test_task_out_of_memory_runs_again_alone(self):
+        server = JobServer(self.directory, workers=1, memory_budget=10e9)
+        server.submit(self.request)
+        server.plan_jobs()
+        task = server.queue.queued_tasks()[0]
+
+        self.assertEqual(server.task_memory_limit(dict(task, predicted_memory=0.1e9)), MIN_MEMORY_LIMIT)
+        self.assertEqual(server.task_memory_limit(dict(task, predicted_memory=8e9)), 10e9)
+
+        # The task was stopped by its own limit, it is queued again with the whole budget
+        future = Future()
+        future.set_result({"status": "failed", "message": "used more than 1.00 GB", "limit": "memory",
+                           "seconds": 1, "memory": None})
+        server.running[task["id"]] = MIN_MEMORY_LIMIT
+        server.task_finished(task, future)
+        self.assertEqual(server.queue.queued_tasks()[0]["predicted_memory"], 10e9)
+
+        # Stopped again with the whole budget, the task fails
+        server.running[task["id"]] = 10e9
+        server.task_finished(task, future)
+        self.assertEqual(server.queue.queued_tasks(), [])
+        server.http_server.server_close()
+
+    def test_dispatching_does_not_wait_for_planning(self):
+        server = JobServer(self.directory, workers=1)
+        planned_job_id, _ = server.submit(self.request)
+        server.plan_jobs()
+
+        # The next job takes a long time to plan
+        planning, release = threading.Event(), threading.Event()
+        plan_job = server.plan_job
+
+        def slow_plan_job(*arguments):
+            planning.set()
+            release.wait()
+            plan_job(*arguments)
+        server.plan_job = slow_plan_job
+        server.submit(dict(self.request, layer_to_options={"TOP": "Conductive Traces AND Vias AND Plane"}))
+
+        for loop in (server.planner_loop, server.scheduler_loop):
+            threading.Thread(target=loop, daemon=True).start()
+        self.assertTrue(planning.wait(10))
+        deadline = time.monotonic() + 10
+        while server.queue.get(planned_job_id)["tasks"][0]["status"] == "queued" and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertNotEqual(server.queue.get(planned_job_id)["tasks"][0]["status"], "queued")
+
+        server.stopped = True
+        release.set()
+        server.pool.shutdown(wait=True)
+        server.http_server.server_close()
+
+    def test_job_that_cannot_be_planned_fails(self):
+        server = JobServer(self.directory, workers=1)
+        job_id, _ = server.submit(dict(self.request, step_arguments={}))
+        server.plan_jobs()
+
+        job = server.queue.get(job_id)
+        self.assertEqual(job["status"], "failed")
+        self.assertIn("KeyError", job["message"])
+        server.http_server.server_close()
+
+    @unittest.skipUnless(UNIX_SOCKETS, "Unix sockets are not available")
+    def test_unix_socket(self):
+        server = JobServer(self.directory, workers=1)
+        threading.Thread(target=server.http_server.serve_forever, daemon=True).start()
+
+        # Only the user running the server may connect
+        self.assertEqual(os.stat(server.address).st_mode & 0o777, 0o600)
+
+        job_id, deduplicated = submit_job(self.dxf_file, self.request["layer_to_options"],
+                                          self.request["step_arguments"], self.directory, address=server.address)
+        self.assertFalse(deduplicated)
+        self.assertEqual(get_job(job_id, address=server.address)["request"]["output_directory"], self.directory)
+        with self.assertRaises(ValueError):
+            get_job("missing", address=server.address)
+
+        server.http_server.shutdown()
+        server.http_server.server_close()
+        self.assertFalse(os.path.exists(server.address))
+        with self.assertRaises(OSError):
+            get_job(job_id, address=server.address)
+
+    def test_only_a_new_directory_is_made_private(self):
+        os.chmod(self.directory, 0o755)
+        JobServer(self.directory, workers=1).http_server.server_close()
+        self.assertEqual(os.stat(self.directory).st_mode & 0o777, 0o755)
+
+        new_directory = os.path.join(self.directory, "jobs")
+        JobServer(new_directory, workers=1).http_server.server_close()
+        self.assertEqual(os.stat(new_directory).st_mode & 0o777, 0o700)
+
+    def test_loopback_jobs_stay_in_the_job_directory(self):
+        server = JobServer(self.directory, workers=1, port=0)
+        threading.Thread(target=server.http_server.serve_forever, daemon=True).start()
+
+        with self.assertRaises(ValueError):
+            submit_job(self.dxf_file, self.request["layer_to_options"], self.request["step_arguments"],
+                       self.directory, address=server.address)
+        job_id, _ = submit_job(self.dxf_file, self.request["layer_to_options"], self.request["step_arguments"],
+                               address=server.address)
+        self.assertEqual(job_output_directory(self.directory, job_id, server.queue.get(job_id)["request"]),
+                         os.path.join(self.directory, job_id))
+
+        server.http_server.shutdown()
+        server.http_server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import importlib
+import sys
+import threading
+import unittest
+
+
+class LazyModule:
+    """
+        LazyModule stands in for a module that is slow to import. The module is imported the first time
+        one of its attributes is used, so code paths that never use it never pay for it.
+
+        Attributes
+        ----------
+        name : str
+            Full name of the module, e.g. 'ezdxf.addons.drawing.matplotlib'
+
+        Methods
+        -------
+        load()
+            Import the module now (if needed) and return it
+
+        is_loaded()
+            Whether the module was imported, by this proxy or by anyone else
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def load(self):
+        if self.module is None:
+            # import_module holds the import lock of the module, so concurrent loads import it once
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+    def is_loaded(self):
+        return self.module is not None or self.name in sys.modules
+
+    def __getattr__(self, attribute):
+        # Only called for attributes that are not set on the proxy itself
+        return getattr(self.load(), attribute)
+
+    def __repr__(self):
+        return f"<LazyModule {self.name}{'' if self.is_loaded() else ' (not loaded)'}>"
+
+
+def warm_up(*modules):
+    """
+        Import LazyModule objects in a background thread, e.g. once the GUI is on screen, so that the first
+        real use does not wait for them. Returns the thread.
+    """
+    def load_all():
+        for module in modules:
+            try:
+                module.load()
+            except ImportError as error:
+                # The first real use raises the error again where it can be reported
+                print(f"Could not preload {module.name}: {error}")
+
+    thread = threading.Thread(target=load_all, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+class TestLazyModule(unittest.TestCase):
+
+    def test_module_is_imported_on_first_use(self):
+        sys.modules.pop("colorsys", None)
+        colorsys = LazyModule("colorsys")
+        self.assertFalse(colorsys.is_loaded())
+
+        self.assertEqual(colorsys.rgb_to_hsv(1, 0, 0), (0, 1, 1))
+        self.assertTrue(colorsys.is_loaded())
+
+    def test_warm_up(self):
+        sys.modules.pop("wave", None)
+        wave = LazyModule("wave")
+        warm_up(wave, LazyModule("module_that_does_not_exist")).join()
+
+        self.assertIn("wave", sys.modules)
+        self.assertIs(wave.module, sys.modules["wave"])
+
+
+if __name__ == "__main__":
+    unittest.main()
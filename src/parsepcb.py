@@ -1,11 +1,16 @@
-import ezdxf
-from ezdxf.addons.drawing import matplotlib
-
 import os.path
 import sys
 import shutil
+import tempfile
 import unittest
 
+from src.geometry import ENTITY_HANDLERS, GeometryStore, LayerGeometry, deduplicate_geometry, geometry_digest
+from src.lazy import LazyModule
+
+# ezdxf and its matplotlib drawing add-on are imported when a file is first read or rendered
+ezdxf = LazyModule("ezdxf")
+matplotlib = LazyModule("ezdxf.addons.drawing.matplotlib")
+
 PATH = os.path.dirname(os.getcwd())
 
 
@@ -19,11 +24,22 @@ class ParsePCB:
         file_path : str
             the path to the DXF file
 
+        render : bool
+            Save PNG previews of the board and its layers. Turned off when files are converted without the GUI.
+
+        scratch_directory : str
+            Turns on the out-of-core mode for boards larger than the memory: the geometry arrays of each
+            layer are written to memory-mapped files in this directory while the file is parsed, and the
+            ezdxf document is released once all layers are on disk
+
         Methods
         -------
         __init__()
             Uses ezdxf.readfile() to extract modelspace and part of the layer to entities mappings
 
+        reload()
+            Reads the file again after it changed, and renders again only the layers whose geometry changed
+
         extract_block_data()
             Extracts the remaining entities that are nested in DXF blocks
 
@@ -32,47 +48,110 @@ class ParsePCB:
             to unique entity types, which will be useful information for the GUI
 
         render_layers()
-            Use layer to entities dictionary to separate the layers and save them as PNG. Note that
-            only lines and circles are extracted for each layer.
+            Use the geometry arrays of each layer to separate the layers and save them as PNG. Note that
+            only entity types with a handler in ENTITY_HANDLERS are extracted for each layer.
 
         get_layer_names()
             Getter function to get the names of the layers. They will be passed to the GUI to populate
             the layers dropdown spinner.
 
+        extract_geometry()
+            Convert the entities of each layer to deduplicated NumPy arrays. The spatial index of a
+            layer is built on demand, see LayerGeometry.get_index().
+            A digest of each layer's geometry is kept to find the layers that changed between revisions.
+
         """
 
-    def __init__(self, file_path):
-        try:
-            # Read file using ezdxf and extract model space
-            self.dxf_file_name = file_path
-            self.dxf_file = ezdxf.readfile(file_path)
-            self.msp = self.dxf_file.modelspace()
-
-            # Use groupby() to get a dictionary (key, val) = (layer, entities)
-            # Note that this does NOT get entities belonging to layers that are
-            # stored in blocks and referenced using INSERT entities
-            self.layers_to_entities = self.msp.groupby(dxfattrib="layer")
-            self.layers = self.layers_to_entities.keys()
-            self.rendered_layers = []
+    def __init__(self, file_path, render=True, scratch_directory=None):
+        self.dxf_file_name = file_path
+        self.render = render
+        self.rendered_layers = []
+        self.layers_to_geometry = {}
+        self.layers_to_digest = {}
+        self.layer_to_entity_types = None
+
+        # Read file using ezdxf and extract model space
+        self.read_file()
 
+        if self.render:
             # Prepare etc folder that will contain runtime data
             directory = 'etc'
             if os.path.exists(directory):
                 shutil.rmtree(directory)
             os.makedirs(directory)
 
-            # Call methods to extract data from DXF file and separate its layers
+        # Out-of-core mode keeps the geometry arrays in memory-mapped files instead of memory
+        self.geometry_store = GeometryStore(scratch_directory) if scratch_directory is not None else None
+
+        # Call methods to extract data from DXF file and separate its layers
+        self.extract_block_data()
+        self.extract_geometry()
+
+        if self.render:
             self.render_board()
-            self.extract_block_data()
             self.render_layers()
 
+        if self.geometry_store is not None:
+            self.release_document()
+
+    def read_file(self):
+        """
+            Read the DXF file and group the entities of its model space by layer
+        """
+        try:
+            dxf_file = ezdxf.readfile(self.dxf_file_name)
+
         except IOError:
-            print(f"Cannot open {file_path} with ezdxf")
+            print(f"Cannot open {self.dxf_file_name} with ezdxf")
             raise IOError("Cannot open DXF file")
         except ezdxf.DXFStructureError:
-            print(f"Cannot open {file_path} because of an issue with the contents of the file")
+            print(f"Cannot open {self.dxf_file_name} because of an issue with the contents of the file")
             raise IOError("Cannot open DXF file")
 
+        self.dxf_file = dxf_file
+        self.msp = self.dxf_file.modelspace()
+        self.layer_to_entity_types = None
+
+        # Use groupby() to get a dictionary (key, val) = (layer, entities)
+        # Note that this does NOT get entities belonging to layers that are
+        # stored in blocks and referenced using INSERT entities
+        self.layers_to_entities = self.msp.groupby(dxfattrib="layer")
+        self.layers = self.layers_to_entities.keys()
+
+    def reload(self):
+        """
+            Read the DXF file again after it changed on disk. The geometry of every layer is extracted
+            again, but only the layers whose geometry digest changed are rendered again.
+            Returns the set of changed layers, including layers that were added or removed.
+        """
+        previous_digests = self.layers_to_digest
+
+        self.read_file()
+        self.extract_block_data()
+        self.extract_geometry()
+
+        changed_layers = {layer for layer in set(previous_digests) | set(self.layers_to_digest)
+                          if previous_digests.get(layer) != self.layers_to_digest.get(layer)}
+        if changed_layers and self.render:
+            self.render_board()
+            self.render_layers(changed_layers)
+
+        if self.geometry_store is not None:
+            self.release_document()
+
+        return changed_layers
+
+    def release_document(self):
+        """
+            Out-of-core mode: once the geometry of every layer is on disk, drop the ezdxf document and its
+            entities. Only the entity types of each layer are kept, for the GUI.
+        """
+        self.layer_to_entity_types = self.get_layer_to_entity_types()
+        self.dxf_file = None
+        self.msp = None
+        self.layers_to_entities = dict.fromkeys(self.layers_to_entities, ())
+        self.layers = self.layers_to_entities.keys()
+
     def extract_block_data(self):
         """
             Extract entities from blocks, and extend the previously built dictionary by adding entities
@@ -80,18 +159,47 @@ class ParsePCB:
         """
         for block in self.dxf_file.blocks:
             for e in block:
-                if (e.dxftype() == 'LINE' or e.dxftype() == 'CIRCLE' or e.dxftype() == 'ARC') \
-                        and e.dxf.layer in self.layers:
+                if e.dxftype() in ENTITY_HANDLERS and e.dxf.layer in self.layers:
                     self.layers_to_entities[e.dxf.layer].append(e)
 
+    def extract_geometry(self):
+        """
+            Build the geometry arrays of each layer once, at parse time. In out-of-core mode the arrays of
+            each layer are written to the geometry store as soon as they are built. Spatial indexes are only
+            built when a later stage asks for them.
+        """
+        previous_digests = self.layers_to_digest
+        self.layers_to_geometry = {}
+        self.layers_to_digest = {}
+        for layer, entities in self.layers_to_entities.items():
+            geometry = deduplicate_geometry(LayerGeometry.from_entities(entities))
+            self.layers_to_digest[layer] = geometry_digest(geometry)
+
+            if self.geometry_store is not None:
+                if previous_digests.get(layer) == self.layers_to_digest[layer]:
+                    # Unchanged since the previous revision, keep the files that are already on disk
+                    geometry = self.geometry_store.read(layer)
+                else:
+                    geometry = self.geometry_store.write(layer, geometry)
+            self.layers_to_geometry[layer] = geometry
+
+        if self.geometry_store is not None:
+            for layer in self.geometry_store.layers():
+                if layer not in self.layers_to_geometry:
+                    self.geometry_store.remove(layer)
+
     def get_layer_to_entity_types(self):
         """
             Iterate over dictionary to identify unique entities for each layer.
             Useful application of this method is to show unique layers before and
             after entities are extracted from blocks
         """
+        if self.layer_to_entity_types is not None:
+            return self.layer_to_entity_types
+
         layer_to_unique_entities = {}
         layer_to_overlooked_entities = {}
+        supported_entities = [entity_type.lower() for entity_type in ENTITY_HANDLERS]
         for layer, entities in self.layers_to_entities.items():
             # Create entry for each layer
             layer_to_unique_entities[layer] = []
@@ -103,9 +211,8 @@ class ParsePCB:
                 if entity_type not in layer_to_unique_entities[layer]:
                     layer_to_unique_entities[layer].append(entity_type)
 
-                # If entity type is not line, circle, or arc, and hasn't been encountered for that
+                # If entity type has no extraction handler, and hasn't been encountered for that
                 # layer, then we add it to the overlooked entities for that layer
-                supported_entities = "line", "circle", "arc"
                 if entity_type not in supported_entities \
                         and entity_type not in layer_to_overlooked_entities[layer]:
                     layer_to_overlooked_entities[layer].append(entity_type)
@@ -113,40 +220,62 @@ class ParsePCB:
         # print(f"Printing layer_to_unique_entities dictionary \n{layer_to_unique_entities}:")
         return layer_to_unique_entities, layer_to_overlooked_entities
 
-    def render_layers(self):
+    def render_layers(self, layers=None):
         """
-            Use layer to entities dictionary to separate the layers and save them as PNG. Note that
-            only lines and circles are extracted for each layer.
+            Use the geometry arrays of each layer to separate the layers and save them as PNG. Note that
+            only entity types with a handler in ENTITY_HANDLERS are extracted for each layer.
+            When a collection of layers is given, only those layers are rendered again and the
+            PNG files of the other layers are kept.
 
             QCR: Q - what to do with Hatch and data types that might be introduced from other boards?
         """
         layers_directory = 'etc/rendered_layers'
-        os.makedirs(layers_directory)
+        os.makedirs(layers_directory, exist_ok=True)
 
-        # Use entities of each layer to create a new ezdxf document and save as PNG
-        for layer, entities in self.layers_to_entities.items():
+        if layers is None:
+            layers = self.layers_to_geometry.keys()
+
+        for layer in layers:
+            # The layer was removed from the file, so its preview is removed as well
+            if layer not in self.layers_to_geometry:
+                self.remove_rendered_layer(layer)
+                continue
+
+            geometry = self.layers_to_geometry[layer]
             doc = ezdxf.new()
             msp = doc.modelspace()
 
-            # Useful layer contains either lines or circles or both
-            useful_layer = False
-
-            for entity in entities:
-                if entity.dxftype() == 'LINE':
-                    msp.add_line(entity.dxf.start, entity.dxf.end)
-                    useful_layer = True
-                elif entity.dxftype() == 'CIRCLE':
-                    msp.add_circle(entity.dxf.center, entity.dxf.radius)
-                    useful_layer = True
-                elif entity.dxftype() == 'ARC':
-                    msp.add_arc(entity.dxf.center, entity.dxf.radius,
-                                entity.dxf.start_angle, entity.dxf.end_angle)
-                    useful_layer = True
+            for x_start, y_start, x_end, y_end in geometry.lines:
+                msp.add_line((x_start, y_start), (x_end, y_end))
+            for x_center, y_center, radius in geometry.circles:
+                msp.add_circle((x_center, y_center), radius)
+            for x_center, y_center, radius, start_angle, end_angle in geometry.arcs:
+                msp.add_arc((x_center, y_center), radius, start_angle, end_angle)
+            for i in range(geometry.polyline_count()):
+                vertices = geometry.polyline_vertices[geometry.polyline_offsets[i]:geometry.polyline_offsets[i + 1]]
+                msp.add_lwpolyline(vertices, format='xyseb', close=bool(geometry.polyline_closed[i]))
+            for i in range(geometry.hatch_count()):
+                hatch = msp.add_hatch()
+                for j, ring in enumerate(geometry.hatch_rings(i)):
+                    # The first ring of a polygon is its outer boundary
+                    hatch.paths.add_polyline_path(ring, is_closed=True, flags=1 if j == 0 else 0)
+
+            # Useful layer contains at least one supported entity
+            useful_layer = geometry.count() > 0
 
             # Save the layer if it is useful
             if useful_layer:
                 matplotlib.qsave(msp, f'{layers_directory}/{layer.lower()}.png')
-                self.rendered_layers.append(layer)
+                if layer not in self.rendered_layers:
+                    self.rendered_layers.append(layer)
+            else:
+                self.remove_rendered_layer(layer)
+
+    def remove_rendered_layer(self, layer):
+        if layer in self.rendered_layers:
+            self.rendered_layers.remove(layer)
+        if os.path.exists(f'etc/rendered_layers/{layer.lower()}.png'):
+            os.remove(f'etc/rendered_layers/{layer.lower()}.png')
 
     def render_board(self):
         matplotlib.qsave(self.msp, 'etc/PCB.png')
@@ -162,10 +291,26 @@ class ParsePCB:
     def get_layer_entities(self):
         """
             Get the layer to entities dictionary, which will be used to generate the 3D printable files.
+            The entities are released in out-of-core mode, use get_layer_geometry() instead.
         """
 
         return self.layers_to_entities
 
+    def get_layer_geometry(self):
+        """
+            Get the layer to geometry arrays dictionary. Each LayerGeometry builds its spatial index on first use.
+        """
+
+        return self.layers_to_geometry
+
+    def get_layer_index(self):
+        """
+            Get the layer to spatial index dictionary. Building every index is expensive on large boards,
+            callers that only need some layers should use get_layer_geometry()[layer].get_index().
+        """
+
+        return {layer: geometry.get_index() for layer, geometry in self.layers_to_geometry.items()}
+
 
 # TODO: Add unit tests for this class
 class TestValidCases(unittest.TestCase):
@@ -212,7 +357,74 @@ class TestValidCases(unittest.TestCase):
             if 'insert' in unique_entities:
                 self.assertTrue('insert' in overlooked_entities)
             if 'hatch' in unique_entities:
-                self.assertTrue('hatch' in overlooked_entities)
+                self.assertFalse('hatch' in overlooked_entities)
+
+
+class TestReload(unittest.TestCase):
+
+    def setUp(self):
+        # The previews are rendered to etc/ in the working directory
+        self.working_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.working_directory)
+        shutil.rmtree(self.directory)
+
+    def test_only_changed_layers_are_rendered(self):
+        file_name = os.path.join(self.directory, 'watched.dxf')
+
+        doc = ezdxf.new()
+        doc.modelspace().add_line((0, 0), (1, 0), dxfattribs={'layer': 'TOP'})
+        doc.modelspace().add_circle((0.5, 0.5), 0.1, dxfattribs={'layer': 'BOTTOM'})
+        doc.saveas(file_name)
+        parser = ParsePCB(file_name)
+        self.assertEqual(sorted(parser.get_layer_names()[1]), ['BOTTOM', 'TOP'])
+
+        # Saving the same geometry in another order does not change any layer
+        doc = ezdxf.new()
+        doc.modelspace().add_circle((0.5, 0.5), 0.1, dxfattribs={'layer': 'BOTTOM'})
+        doc.modelspace().add_line((1, 0), (0, 0), dxfattribs={'layer': 'TOP'})
+        doc.saveas(file_name)
+        self.assertEqual(parser.reload(), set())
+
+        # Moving a trace only changes its layer, and a layer that lost all of its geometry loses its preview
+        doc = ezdxf.new()
+        doc.modelspace().add_line((0, 0), (1, 0.5), dxfattribs={'layer': 'TOP'})
+        doc.saveas(file_name)
+        self.assertEqual(parser.reload(), {'TOP', 'BOTTOM'})
+        self.assertEqual(parser.get_layer_names()[1], ['TOP'])
+        self.assertTrue(os.path.exists('etc/rendered_layers/top.png'))
+        self.assertFalse(os.path.exists('etc/rendered_layers/bottom.png'))
+
+
+class TestOutOfCore(unittest.TestCase):
+
+    def test_geometry_is_kept_on_disk(self):
+        directory = tempfile.mkdtemp()
+        file_name = os.path.join(directory, 'board.dxf')
+
+        doc = ezdxf.new()
+        doc.modelspace().add_line((0, 0), (1, 0), dxfattribs={'layer': 'TOP'})
+        doc.modelspace().add_circle((0.5, 0.5), 0.1, dxfattribs={'layer': 'BOTTOM'})
+        doc.modelspace().add_text('label', dxfattribs={'layer': 'BOTTOM'})
+        doc.saveas(file_name)
+
+        parser = ParsePCB(file_name, render=False, scratch_directory=os.path.join(directory, 'geometry'))
+        self.assertIsNone(parser.dxf_file)
+        self.assertFalse(parser.get_layer_geometry()['TOP'].lines.flags.writeable)
+        self.assertEqual(parser.get_layer_to_entity_types()[1]['BOTTOM'], ['text'])
+        bottom_path = parser.geometry_store.layer_path('BOTTOM')
+
+        # Only the layer that changed is written again
+        doc.modelspace().add_line((0, 0), (0, 1), dxfattribs={'layer': 'TOP'})
+        doc.saveas(file_name)
+        self.assertEqual(parser.reload(), {'TOP'})
+        self.assertEqual(parser.geometry_store.layer_path('BOTTOM'), bottom_path)
+        self.assertEqual(len(parser.get_layer_geometry()['TOP'].lines), 2)
+
+        shutil.rmtree(directory)
 
 
 class TestErrorCases(unittest.TestCase):
@@ -0,0 +1,267 @@
+import unittest
+
+import numpy as np
+
+# Boxes that span more grid cells than this are not registered in the cells, but kept in a list that every
+# query checks. Registering long items (e.g. board-spanning diagonal fill lines) in every cell they cover
+# would take memory quadratic in their number.
+MAX_CELLS_PER_ITEM = 16
+
+
+class GridIndex:
+    """
+        GridIndex is a bulk-loaded uniform grid over axis-aligned bounding boxes. Every box is
+        registered in each cell it overlaps, and the (cell, item) pairs are kept sorted by cell
+        key, so looking up a row of cells is a binary search instead of a scan over all items.
+
+        Attributes
+        ----------
+        bounds : numpy.ndarray
+            (N, 4) array of bounding boxes stored as x_min, y_min, x_max, y_max
+
+        cell_size : float
+            Side of the square grid cells (inches)
+
+        large : numpy.ndarray
+            Indices of the boxes that span more than MAX_CELLS_PER_ITEM cells, checked by every query
+
+        Methods
+        -------
+        query_rect()
+            Indices of the boxes that intersect a rectangle
+
+        query_radius()
+            Indices of the boxes that come within a radius of a point
+
+        nearest()
+            Indices of the boxes closest to a point
+    """
+
+    def __init__(self, bounds, cell_size=None):
+        self.bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        count = len(self.bounds)
+
+        if count:
+            self.origin = self.bounds[:, :2].min(axis=0)
+            extent = self.bounds[:, 2:].max(axis=0) - self.origin
+        else:
+            self.origin = np.zeros(2)
+            extent = np.zeros(2)
+
+        # By default aim for roughly one item per cell
+        if cell_size is None:
+            cell_size = max(extent.max(), 1e-9) / max(np.sqrt(count), 1)
+        self.cell_size = float(cell_size)
+        self.columns, self.rows = (np.floor(extent / self.cell_size).astype(np.int64) + 1)
+
+        first_cells = self._cells(self.bounds[:, :2])
+        last_cells = self._cells(self.bounds[:, 2:])
+        widths = last_cells[:, 0] - first_cells[:, 0] + 1
+        cells_per_item = widths * (last_cells[:, 1] - first_cells[:, 1] + 1)
+
+        self.large = np.flatnonzero(cells_per_item > MAX_CELLS_PER_ITEM)
+        cells_per_item[self.large] = 0
+
+        # Expand every item into the cells it covers without a Python loop
+        items = np.repeat(np.arange(count), cells_per_item)
+        local = np.arange(len(items)) - np.repeat(np.cumsum(cells_per_item) - cells_per_item, cells_per_item)
+        repeated_widths = np.repeat(widths, cells_per_item)
+        cell_x = np.repeat(first_cells[:, 0], cells_per_item) + local % repeated_widths
+        cell_y = np.repeat(first_cells[:, 1], cells_per_item) + local // repeated_widths
+
+        keys = cell_y * self.columns + cell_x
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.items = items[order]
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def _cells(self, points):
+        cells = np.floor((np.asarray(points, dtype=np.float64).reshape(-1, 2) - self.origin) / self.cell_size)
+        return np.clip(cells, 0, [self.columns - 1, self.rows - 1]).astype(np.int64)
+
+    def _candidates(self, x_min, y_min, x_max, y_max):
+        if not len(self) or x_max < x_min or y_max < y_min:
+            return np.arange(0)
+        (column_min, row_min), (column_max, row_max) = self._cells([(x_min, y_min), (x_max, y_max)])
+
+        # Cells of a grid row are contiguous in key order, so each row is a single slice
+        rows = np.arange(row_min, row_max + 1)
+        starts = np.searchsorted(self.keys, rows * self.columns + column_min, side="left")
+        ends = np.searchsorted(self.keys, rows * self.columns + column_max, side="right")
+
+        return np.unique(np.concatenate([self.large] + [self.items[start:end] for start, end in zip(starts, ends)]))
+
+    def query_rect(self, x_min, y_min, x_max, y_max):
+        candidates = self._candidates(x_min, y_min, x_max, y_max)
+        boxes = self.bounds[candidates]
+        hits = (boxes[:, 0] <= x_max) & (boxes[:, 2] >= x_min) & (boxes[:, 1] <= y_max) & (boxes[:, 3] >= y_min)
+        return candidates[hits]
+
+    def distances(self, x, y, indices=None):
+        """
+            Distance from a point to the boxes (zero when the point is inside a box)
+        """
+        boxes = self.bounds if indices is None else self.bounds[indices]
+        dx = np.maximum(np.maximum(boxes[:, 0] - x, x - boxes[:, 2]), 0)
+        dy = np.maximum(np.maximum(boxes[:, 1] - y, y - boxes[:, 3]), 0)
+        return np.hypot(dx, dy)
+
+    def query_radius(self, x, y, radius):
+        candidates = self._candidates(x - radius, y - radius, x + radius, y + radius)
+        return candidates[self.distances(x, y, candidates) <= radius]
+
+    def nearest(self, x, y, count=1):
+        """
+            Indices of the count boxes closest to the point, closest first. The search radius
+            grows one ring of cells at a time until enough boxes are found.
+        """
+        count = min(count, len(self))
+        if count == 0:
+            return np.arange(0)
+
+        radius = self.cell_size
+        while True:
+            candidates = self.query_radius(x, y, radius)
+            if len(candidates) >= count:
+                distances = self.distances(x, y, candidates)
+                return candidates[np.argsort(distances, kind="stable")[:count]]
+            radius *= 2
+
+
+def segment_distances(segments, x, y):
+    """
+        Distance from a point to each segment of an (N, 4) array of x_start, y_start, x_end, y_end
+    """
+    start = segments[:, :2]
+    direction = segments[:, 2:] - start
+    length_squared = (direction ** 2).sum(axis=1)
+    t = np.divide(((np.array([x, y]) - start) * direction).sum(axis=1), length_squared,
+                  out=np.zeros(len(segments)), where=length_squared > 0)
+    closest = start + direction * np.clip(t, 0, 1)[:, None]
+    return np.hypot(closest[:, 0] - x, closest[:, 1] - y)
+
+
+class LayerIndex:
+    """
+        LayerIndex groups the spatial indexes of one layer's geometry arrays. It is built on first
+        use by LayerGeometry.get_index() and then kept with the geometry. Generation queries the index
+        of the drill map for the holes under every filled area, see DrillMap.query_rect().
+
+        Attributes
+        ----------
+        lines, circles, arcs : GridIndex
+            Indexes over the bounding boxes of the layer's segments, circles, and arcs
+            (arcs are indexed by their full circle)
+
+        polylines, hatches : GridIndex
+            Indexes over the bounding boxes of the layer's polylines and filled polygons
+
+        endpoints : GridIndex
+            Index over segment endpoints. Endpoint i belongs to segment i // 2.
+
+        Methods
+        -------
+        query_rect()
+            Segments, circles, arcs, polylines, and filled polygons that intersect a rectangle
+
+        lines_touching_circle()
+            Segments that come within the radius of a point, e.g. the traces connected to a via
+
+        nearest_endpoints()
+            Segments whose endpoints are closest to a point
+    """
+
+    def __init__(self, geometry):
+        lines = geometry.lines
+        self.lines = GridIndex(np.column_stack((np.minimum(lines[:, 0], lines[:, 2]),
+                                                np.minimum(lines[:, 1], lines[:, 3]),
+                                                np.maximum(lines[:, 0], lines[:, 2]),
+                                                np.maximum(lines[:, 1], lines[:, 3]))))
+        self.circles = GridIndex(_circle_bounds(geometry.circles))
+        self.arcs = GridIndex(_circle_bounds(geometry.arcs))
+        self.polylines = GridIndex(geometry.polyline_bounds())
+        self.hatches = GridIndex(geometry.hatch_bounds())
+
+        endpoints = lines.reshape(-1, 2)
+        self.endpoints = GridIndex(np.column_stack((endpoints, endpoints)))
+        self.segments = lines
+
+    def query_rect(self, x_min, y_min, x_max, y_max):
+        return (self.lines.query_rect(x_min, y_min, x_max, y_max),
+                self.circles.query_rect(x_min, y_min, x_max, y_max),
+                self.arcs.query_rect(x_min, y_min, x_max, y_max),
+                self.polylines.query_rect(x_min, y_min, x_max, y_max),
+                self.hatches.query_rect(x_min, y_min, x_max, y_max))
+
+    def lines_touching_circle(self, x, y, radius):
+        candidates = self.lines.query_radius(x, y, radius)
+        return candidates[segment_distances(self.segments[candidates], x, y) <= radius]
+
+    def nearest_endpoints(self, x, y, count=1):
+        """
+            Returns the segment indices and which end (0 for start, 1 for end) of the
+            count endpoints closest to the point
+        """
+        endpoints = self.endpoints.nearest(x, y, count)
+        return endpoints // 2, endpoints % 2
+
+
+def _circle_bounds(circles):
+    return np.column_stack((circles[:, 0] - circles[:, 2], circles[:, 1] - circles[:, 2],
+                            circles[:, 0] + circles[:, 2], circles[:, 1] + circles[:, 2]))
+
+
+class TestGridIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        corners = rng.uniform(0, 2, (500, 2))
+        self.bounds = np.column_stack((corners, corners + rng.uniform(0, 0.2, (500, 2))))
+        self.index = GridIndex(self.bounds)
+
+    def test_query_rect_matches_linear_scan(self):
+        for x_min, y_min, x_max, y_max in [(0.5, 0.5, 0.7, 0.9), (-1, -1, 0.1, 0.1), (1.9, 0, 3, 3), (5, 5, 6, 6)]:
+            expected = np.flatnonzero((self.bounds[:, 0] <= x_max) & (self.bounds[:, 2] >= x_min) &
+                                      (self.bounds[:, 1] <= y_max) & (self.bounds[:, 3] >= y_min))
+            self.assertTrue(np.array_equal(self.index.query_rect(x_min, y_min, x_max, y_max), expected))
+
+    def test_query_radius_and_nearest(self):
+        distances = self.index.distances(1, 1)
+        self.assertTrue(np.array_equal(self.index.query_radius(1, 1, 0.1), np.flatnonzero(distances <= 0.1)))
+        self.assertTrue(np.allclose(distances[self.index.nearest(1, 1, 5)], np.sort(distances)[:5]))
+
+    def test_long_items_are_not_registered_per_cell(self):
+        # Board-spanning diagonals, like a dense 45 degree LINE fill
+        offsets = np.linspace(0, 2, 2000)
+        bounds = np.column_stack((offsets, offsets * 0, offsets + 2, offsets * 0 + 2))
+        index = GridIndex(np.concatenate((bounds, self.bounds)))
+
+        self.assertEqual(len(index.large), 2000)
+        self.assertLess(len(index.keys), 20 * len(self.bounds))
+        expected = np.flatnonzero((index.bounds[:, 0] <= 0.6) & (index.bounds[:, 2] >= 0.5) &
+                                  (index.bounds[:, 1] <= 0.9) & (index.bounds[:, 3] >= 0.5))
+        self.assertTrue(np.array_equal(index.query_rect(0.5, 0.5, 0.6, 0.9), expected))
+
+    def test_empty_index(self):
+        index = GridIndex(np.empty((0, 4)))
+        self.assertEqual(len(index.query_rect(0, 0, 1, 1)), 0)
+        self.assertEqual(len(index.nearest(0, 0)), 0)
+
+
+class TestLayerIndex(unittest.TestCase):
+
+    def test_traces_touching_via(self):
+        from src.geometry import LayerGeometry
+
+        geometry = LayerGeometry(lines=[(0, 0, 1, 0), (1, 0, 1, 1), (0, 0.5, 0.4, 0.5)], circles=[(1, 0, 0.05)])
+        index = LayerIndex(geometry)
+
+        self.assertTrue(np.array_equal(index.lines_touching_circle(1, 0, 0.05), [0, 1]))
+        segments, ends = index.nearest_endpoints(0.45, 0.5)
+        self.assertEqual((segments[0], ends[0]), (2, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
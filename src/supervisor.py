@@ -0,0 +1,433 @@
+import contextlib
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from src.costmodel import DEFAULT_SECONDS, PLANE_OPTION, layer_features, peak_memory
+from src.drillmap import DRILL_ONLY, DrillMap
+from src.generatesteps import GenerateSteps, create_output_directory, step_file_name
+from src.geometry import LayerGeometry
+
+# Seconds a layer may take by default. Boards that really take longer should raise it.
+DEFAULT_TIMEOUT = 600
+
+# Trial runs of a layer being bisected may take this many times the predicted time of the whole layer, but at
+# least MIN_TRIAL_TIMEOUT seconds, which covers starting a process and importing CadQuery
+TRIAL_TIMEOUT_FACTOR = 3
+MIN_TRIAL_TIMEOUT = 30
+
+# Seconds between checks of a running layer's time and memory
+POLL_INTERVAL = 0.1
+
+# Kinds of primitives that are bisected, in the order they are listed in reports. Circles of a layer are
+# left out, they only become holes through the drill map.
+PRIMITIVE_KINDS = ("lines", "arcs", "polylines", "hatches", "holes")
+
+# Statuses of runs that were stopped by a limit. Only runs that raise or crash are bisected: a primitive that
+# makes a layer slow or large cannot be told apart from the primitives that merely add to its cost.
+LIMITS = ("timeout", "memory")
+
+
+class LimitExceeded(Exception):
+    """
+        A trial run of a layer being bisected was stopped by its time or memory limit
+    """
+
+
+def resident_memory(pid):
+    """
+        Resident memory (bytes) of a process, or None where it cannot be read
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def generate_layers(connection, layer_to_geometry, layer_to_options, step_arguments, drill_map, output_directory,
+                    quiet):
+    """
+        Entry point of the process that generates layers. Sends ("layer", name) whenever a layer is finished,
+        then ("done", peak memory) or ("failed", error) back to the supervisor. A crash or a kill sends nothing.
+    """
+    os.chdir(output_directory)
+    # Trial runs of a layer being bisected would repeat the same progress messages many times
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if quiet else sys.stdout):
+        try:
+            # Layers are written and released one by one, and plane layers share the drilled plane
+            GenerateSteps(layer_to_geometry, layer_to_options, clean_output=False, keep_workplanes=False,
+                          drill_map=drill_map, layer_finished=lambda layer: connection.send(("layer", layer)),
+                          **step_arguments)
+        except Exception as error:
+            connection.send(("failed", f"{type(error).__name__}: {error}"))
+            return
+    connection.send(("done", peak_memory()))
+
+
+def layer_report(layer, status, message="", culprits=(), limit=None, seconds=0.0, memory=None):
+    return {"layer": layer, "status": status, "message": message, "culprits": list(culprits), "limit": limit,
+            "seconds": seconds, "memory": memory}
+
+
+class LayerSupervisor:
+    """
+        LayerSupervisor generates layers in separate processes, so that an OCC boolean that hangs, runs out
+        of memory, or crashes the interpreter only costs the layer it happened in. Every layer gets a time
+        and memory budget. When an OCC operation raises or crashes, the layer's primitives are bisected in
+        further processes until the primitives that make it fail are isolated. The layer is then written
+        without them, and they are reported, so that batch runs finish every layer they can. Layers stopped
+        by their time or memory limit are reported as failed without bisecting them.
+
+        Attributes
+        ----------
+        layer_to_options : dict
+            Maps layers to their GenerateSteps option
+
+        step_arguments : dict
+            Keyword arguments passed to GenerateSteps (pcb_width, pcb_height, layer_thickness,
+            conductive_trace_width, conductive_trace_thickness, and optionally the output mode)
+
+        drill_map : DrillMap
+            Holes of the whole board, see GenerateSteps
+
+        output_directory : str
+            Directory that receives STEP_files
+
+        timeout : float
+            Seconds a layer may run before it is killed. Trial runs of a layer being bisected get a budget
+            derived from the predicted time of the layer instead, see trial_timeout().
+
+        memory_limit : float
+            Resident memory (bytes) a layer may use before it is killed, None for no limit. Only enforced
+            where the memory of a process can be read (Linux).
+
+        Methods
+        -------
+        run()
+            Generate a layer and return its report: status ("done", "partial", or "failed"), message,
+            culprits (kind, index, values), limit ("timeout" or "memory" if one stopped the layer),
+            seconds, and peak memory
+
+        run_all()
+            Generate several layers in one process, so that plane layers share the drilled plane, and run()
+            the layers that fail on their own
+
+        attempt()
+            Generate a subset of a layer's primitives (or the whole layer for None) in a new process, returns
+            (status, message, memory)
+
+        isolate()
+            Bisect a failing set of primitives down to a minimal set that still fails
+    """
+
+    def __init__(self, layer_to_options, step_arguments, drill_map, output_directory=".", timeout=DEFAULT_TIMEOUT,
+                 memory_limit=None):
+        self.layer_to_options = layer_to_options
+        self.step_arguments = step_arguments
+        self.drill_map = drill_map
+        self.output_directory = os.path.abspath(output_directory)
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+
+        # Same start method as the job server's workers, children do not inherit OCC state or threads
+        self.context = multiprocessing.get_context("spawn")
+
+    def run(self, layer, geometry, predicted_seconds=None):
+        start = time.perf_counter()
+        primitives = self.primitives(layer, geometry)
+
+        def report(status, message, culprits=(), limit=None, memory=None):
+            return layer_report(layer, status, message, culprits, limit, time.perf_counter() - start, memory)
+
+        status, message, memory = self.attempt(layer, geometry, None, self.output_directory, quiet=False)
+        if status == "done":
+            return report("done", "", memory=memory)
+        if status in LIMITS:
+            return report("failed", f"{message}, layers that run out of time or memory are not bisected",
+                          limit=status)
+        print(f"{layer} failed ({message}), looking for the primitives that cause it")
+
+        # Trial runs write to a scratch directory, so that a partial layer never replaces a good STEP file
+        timeout = self.trial_timeout(layer, geometry, predicted_seconds)
+        scratch_directory = tempfile.mkdtemp(prefix="bisect_")
+        try:
+            if not self.trial(layer, geometry, [], scratch_directory, timeout):
+                return report("failed", f"{message}, even without its primitives")
+
+            culprits = []
+            remaining = primitives
+            while True:
+                isolated = set(self.isolate(layer, geometry, remaining, [], scratch_directory, timeout))
+                culprits.extend(primitive for primitive in remaining if primitive in isolated)
+                remaining = [primitive for primitive in remaining if primitive not in isolated]
+                if not remaining or self.trial(layer, geometry, remaining, scratch_directory, timeout):
+                    break
+        except LimitExceeded as error:
+            return report("failed", f"{message}. Stopped looking for the primitives that cause it, a trial run {error}")
+        finally:
+            shutil.rmtree(scratch_directory, ignore_errors=True)
+
+        status, _, _ = self.attempt(layer, geometry, remaining, self.output_directory)
+        culprit_values = [(kind, index, self.primitive_values(geometry, kind, index)) for kind, index in culprits]
+        described = ", ".join(f"{kind[:-1]} {index} {np.round(values, 4).tolist()}"
+                              for kind, index, values in culprit_values)
+        return report("partial" if status == "done" else "failed", f"{message}. Left out {described}",
+                      culprit_values, status if status in LIMITS else None)
+
+    def run_all(self, layer_to_geometry):
+        reports = []
+        remaining = list(layer_to_geometry)
+        while remaining:
+            finished, status, message, _ = self.generate({layer: layer_to_geometry[layer] for layer in remaining},
+                                                         self.drill_map, self.output_directory, quiet=False)
+            reports.extend(layer_report(layer, "done", seconds=seconds) for layer, seconds in finished)
+            remaining = remaining[len(finished):]
+            if status == "done" or not remaining:
+                break
+
+            # The layer that was running when the process failed, the layers after it run in a new process
+            layer = remaining.pop(0)
+            if status in LIMITS:
+                reports.append(layer_report(layer, "failed", f"{message}, layers that run out of time or memory "
+                                                             f"are not bisected", limit=status))
+            else:
+                print(f"{layer} failed ({message}), generating it on its own")
+                reports.append(self.run(layer, layer_to_geometry[layer]))
+
+        return reports
+
+    def primitives(self, layer, geometry):
+        counts = {"lines": len(geometry.lines), "arcs": len(geometry.arcs), "polylines": geometry.polyline_count(),
+                  "hatches": geometry.hatch_count(),
+                  "holes": len(self.drill_map) if self.layer_to_options[layer] == PLANE_OPTION else 0}
+        return [(kind, index) for kind in PRIMITIVE_KINDS for index in range(counts[kind])]
+
+    def primitive_values(self, geometry, kind, index):
+        if kind == "holes":
+            return self.drill_map.holes[index]
+        if kind == "polylines":
+            return geometry.select_polylines([index])[0][:, :2]
+        if kind == "hatches":
+            return geometry.select_hatches([index])[0][:, :2]
+        return getattr(geometry, kind)[index]
+
+    def trial_timeout(self, layer, geometry, predicted_seconds=None):
+        """
+            Seconds a trial run of a layer being bisected may take. A subset of a layer that takes much longer
+            than the whole layer is predicted to is stuck, and waiting for the full timeout in every trial
+            would multiply it by the number of trials.
+        """
+        if predicted_seconds is None:
+            features = layer_features(geometry, self.layer_to_options[layer], len(self.drill_map))
+            predicted_seconds = float(features @ np.array(DEFAULT_SECONDS))
+        return min(self.timeout, max(MIN_TRIAL_TIMEOUT, TRIAL_TIMEOUT_FACTOR * predicted_seconds))
+
+    def attempt(self, layer, geometry, primitives, output_directory, quiet=True, timeout=None):
+        # The whole layer is passed on as it is, so that memory-mapped geometry is not copied
+        subset, drill_map = geometry, self.drill_map
+        if primitives is not None:
+            kind_to_indices = {kind: [] for kind in PRIMITIVE_KINDS}
+            for kind, index in primitives:
+                kind_to_indices[kind].append(index)
+            subset = geometry.select(lines=kind_to_indices["lines"], arcs=kind_to_indices["arcs"],
+                                     polylines=kind_to_indices["polylines"], hatches=kind_to_indices["hatches"])
+            if self.layer_to_options[layer] == PLANE_OPTION:
+                drill_map = DrillMap(self.drill_map.holes[np.asarray(kind_to_indices["holes"], dtype=np.int64)])
+
+        _, status, message, memory = self.generate({layer: subset}, drill_map, output_directory, quiet, timeout)
+        return status, message, memory
+
+    def trial(self, layer, geometry, primitives, output_directory, timeout):
+        """
+            Whether a subset of a layer is generated. Raises LimitExceeded if the trial is stopped by a limit.
+        """
+        status, message, _ = self.attempt(layer, geometry, primitives, output_directory, timeout=timeout)
+        if status in LIMITS:
+            raise LimitExceeded(message)
+        return status == "done"
+
+    def generate(self, layer_to_geometry, drill_map, output_directory, quiet=True, timeout=None):
+        """
+            Generate layers in a new process. Every layer may take timeout seconds (the supervisor's timeout by
+            default). Returns the finished layers with their seconds, the status ("done", "failed", "timeout",
+            or "memory"), the error message, and the peak memory of the process if it finished.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        layer_to_options = {layer: self.layer_to_options[layer] for layer in layer_to_geometry}
+
+        receiver, sender = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=generate_layers, daemon=True,
+                                       args=(sender, layer_to_geometry, layer_to_options, self.step_arguments,
+                                             drill_map, output_directory, quiet))
+        process.start()
+        sender.close()
+
+        finished = []
+        result = None
+        layer_start = time.monotonic()
+
+        def receive():
+            nonlocal result, layer_start
+            try:
+                while receiver.poll():
+                    kind, value = receiver.recv()
+                    if kind == "layer":
+                        # Every layer gets the full timeout
+                        finished.append((value, time.monotonic() - layer_start))
+                        layer_start = time.monotonic()
+                    else:
+                        result = (kind, value)
+            except EOFError:
+                pass
+
+        limit = None
+        while process.is_alive():
+            process.join(POLL_INTERVAL)
+            receive()
+            memory = resident_memory(process.pid) if process.is_alive() else None
+            if time.monotonic() - layer_start > timeout:
+                limit, message = "timeout", f"timed out after {timeout:g} s"
+            elif self.memory_limit is not None and memory is not None and memory > self.memory_limit:
+                limit, message = "memory", f"used more than {self.memory_limit / 1e9:.2f} GB"
+            if limit is not None:
+                process.kill()
+                process.join()
+        # Messages sent right before the process exited
+        receive()
+        receiver.close()
+
+        if limit is not None:
+            return finished, limit, message, None
+        if result is None:
+            return finished, "failed", f"worker process crashed (exit code {process.exitcode})", None
+        if result[0] == "failed":
+            return finished, "failed", result[1], None
+        return finished, "done", "", result[1]
+
+    def isolate(self, layer, geometry, primitives, context, output_directory, timeout):
+        """
+            Primitives known to fail together with the context, while the context alone does not fail.
+            Halves that fail on their own are bisected further. When neither half fails alone, the failure
+            needs primitives of both, and each half is bisected with the other one as context.
+        """
+        if len(primitives) <= 1:
+            return list(primitives)
+
+        first, second = primitives[:len(primitives) // 2], primitives[len(primitives) // 2:]
+        if not self.trial(layer, geometry, context + first, output_directory, timeout):
+            return self.isolate(layer, geometry, first, context, output_directory, timeout)
+        if not self.trial(layer, geometry, context + second, output_directory, timeout):
+            return self.isolate(layer, geometry, second, context, output_directory, timeout)
+        return self.isolate(layer, geometry, first, context + second, output_directory, timeout) + \
+            self.isolate(layer, geometry, second, context + first, output_directory, timeout)
+
+
+def generate_supervised(layer_to_geometry, layer_to_options, step_arguments, output_directory=".", clean_output=True,
+                        timeout=DEFAULT_TIMEOUT, memory_limit=None, drill_map=None):
+    """
+        Generate the STEP files of several layers under a LayerSupervisor, and return their reports. By default
+        holes are collected from all the given layers once, like GenerateSteps does.
+    """
+    drill_layers = [layer for layer in layer_to_geometry if layer_to_options[layer] == DRILL_ONLY]
+    if drill_map is None:
+        drill_map = DrillMap.from_layers(layer_to_geometry, drill_layers or None)
+    create_output_directory(clean_output, os.path.join(output_directory, "STEP_files"))
+
+    supervisor = LayerSupervisor(layer_to_options, step_arguments, drill_map, output_directory, timeout, memory_limit)
+    return supervisor.run_all({layer: geometry for layer, geometry in layer_to_geometry.items()
+                               if layer not in drill_layers})
+
+
+class TestLayerSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.step_arguments = {"pcb_width": 1, "pcb_height": 1, "layer_thickness": 0.04,
+                               "conductive_trace_width": 0.00005, "conductive_trace_thickness": 0.01}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_layers_are_generated_in_one_process(self):
+        layer_to_geometry = {"TOP": LayerGeometry(lines=[(0.1, 0.1, 0.9, 0.1)]),
+                             "BOTTOM": LayerGeometry(lines=[(0.1, 0.2, 0.9, 0.2)])}
+        supervisor = LayerSupervisor({"TOP": "Conductive Traces only", "BOTTOM": "Conductive Traces only"},
+                                     self.step_arguments, DrillMap(), self.directory)
+
+        finished, status, _, _ = supervisor.generate(layer_to_geometry, DrillMap(), self.directory)
+        self.assertEqual(status, "done")
+        self.assertEqual([layer for layer, _ in finished], ["TOP", "BOTTOM"])
+
+        reports = generate_supervised(layer_to_geometry, supervisor.layer_to_options, self.step_arguments,
+                                      self.directory)
+        self.assertEqual([(report["layer"], report["status"]) for report in reports], [("TOP", "done"),
+                                                                                      ("BOTTOM", "done")])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, step_file_name("BOTTOM"))))
+
+    def test_bad_primitive_is_isolated(self):
+        # A polyline whose vertices all coincide has no outline to offset, and fails the layer
+        geometry = LayerGeometry(lines=[(0.1, 0.1 * i, 0.9, 0.1 * i) for i in range(1, 6)],
+                                 polyline_vertices=[(0.2, 0.2, 0, 0, 0.5), (0.2, 0.2, 0, 0, 0)],
+                                 polyline_offsets=[0, 2], polyline_closed=[False])
+        layer_to_options = {"TOP": "Conductive Traces only", "BOTTOM": "Conductive Traces only"}
+        supervisor = LayerSupervisor(layer_to_options, self.step_arguments, DrillMap(), self.directory)
+        if supervisor.attempt("TOP", geometry, None, self.directory)[0] == "done":
+            self.skipTest("this OCC version offsets the degenerate polyline")
+
+        # The layer after the failing one is still generated
+        reports = generate_supervised({"TOP": geometry, "BOTTOM": LayerGeometry(lines=[(0.1, 0.2, 0.9, 0.2)])},
+                                      layer_to_options, self.step_arguments, self.directory)
+        self.assertEqual([report["status"] for report in reports], ["partial", "done"])
+        self.assertEqual([culprit[:2] for culprit in reports[0]["culprits"]], [("polylines", 0)])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, step_file_name("TOP"))))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, step_file_name("BOTTOM"))))
+
+    def test_limits(self):
+        supervisor = LayerSupervisor({"TOP": "Conductive Traces only"}, self.step_arguments, DrillMap(),
+                                     self.directory, timeout=0.01)
+        self.assertEqual(supervisor.attempt("TOP", LayerGeometry(), [], self.directory)[:2],
+                         ("timeout", "timed out after 0.01 s"))
+
+        # A layer that runs out of time is not bisected
+        report = supervisor.run("TOP", LayerGeometry(lines=[(0.1, 0.1, 0.9, 0.1)]))
+        self.assertEqual((report["status"], report["limit"], report["culprits"]), ("failed", "timeout", []))
+
+        if resident_memory(os.getpid()) is None:
+            self.skipTest("the memory of a process cannot be read on this platform")
+        supervisor = LayerSupervisor({"TOP": "Conductive Traces only"}, self.step_arguments, DrillMap(),
+                                     self.directory, memory_limit=1)
+        self.assertEqual(supervisor.attempt("TOP", LayerGeometry(), [], self.directory)[:2],
+                         ("memory", "used more than 0.00 GB"))
+
+    def test_bisection_stops_when_a_trial_runs_out_of_time(self):
+        geometry = LayerGeometry(lines=[(0.1, 0.1 * i, 0.9, 0.1 * i) for i in range(1, 5)])
+        supervisor = LayerSupervisor({"TOP": "Conductive Traces only"}, self.step_arguments, DrillMap(),
+                                     self.directory)
+        self.assertEqual(supervisor.trial_timeout("TOP", geometry, predicted_seconds=100), 300)
+        self.assertEqual(supervisor.trial_timeout("TOP", geometry, predicted_seconds=1000), DEFAULT_TIMEOUT)
+        self.assertEqual(supervisor.trial_timeout("TOP", geometry), MIN_TRIAL_TIMEOUT)
+
+        # The whole layer raises, the empty layer is generated, and every other trial times out
+        def attempt(layer, geometry, primitives, output_directory, quiet=True, timeout=None):
+            if primitives is None:
+                return "failed", "StdFail_NotDone", None
+            if not primitives:
+                return "done", "", 0
+            return "timeout", f"timed out after {timeout:g} s", None
+        supervisor.attempt = attempt
+
+        report = supervisor.run("TOP", geometry)
+        self.assertEqual(report["status"], "failed")
+        self.assertIn(f"a trial run timed out after {MIN_TRIAL_TIMEOUT:g} s", report["message"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,254 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from src.drillmap import DRILL_ONLY, DrillMap
+from src.generatesteps import step_file_name
+from src.parsepcb import ParsePCB, ezdxf
+from src.supervisor import generate_supervised
+
+TRACES_ONLY = "Conductive Traces only"
+TRACES_AND_PLANE = "Conductive Traces AND Vias AND Plane"
+
+
+def file_signature(file_path):
+    """
+        Modification time and size of a file, or None while the file does not exist
+        (editors often replace a file by deleting it and writing a new one)
+    """
+    try:
+        status = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return status.st_mtime_ns, status.st_size
+
+
+class WatchDXF:
+    """
+        WatchDXF polls a DXF file and keeps the layer previews and STEP files up to date while the
+        design is revised. On every change the file is parsed again, the geometry of each layer is
+        compared to the previous revision by digest, and only the layers that changed are rendered
+        and turned into STEP files again. Previews and STEP files of untouched layers are kept.
+        When the holes of the board change, all the plane layers are generated again.
+
+        Attributes
+        ----------
+        file_path : str
+            the path to the DXF file
+
+        layer_to_options : dict
+            Maps the layers to generate to their GenerateSteps option
+
+        step_arguments : dict
+            Keyword arguments passed to GenerateSteps (pcb_width, pcb_height, layer_thickness,
+            conductive_trace_width, conductive_trace_thickness, and optionally the output mode)
+
+        parser : ParsePCB
+            Parser of the current revision. An existing parser (e.g. the GUI's) can be passed in.
+
+        Methods
+        -------
+        poll()
+            Check the file once. Returns the set of changed layers after a new revision was
+            processed, otherwise None.
+
+        regenerate()
+            Write the STEP files of the given layers under a LayerSupervisor, and remove those of layers that no
+            longer have geometry
+
+        board_drill_map()
+            Collect the holes shared by the plane layers
+
+        run()
+            Poll the file until interrupted
+    """
+
+    def __init__(self, file_path, layer_to_options, step_arguments, parser=None, interval=1.0):
+        self.file_path = file_path
+        self.layer_to_options = layer_to_options
+        self.step_arguments = step_arguments
+        self.interval = interval
+
+        self.parser = parser if parser is not None else ParsePCB(file_path)
+        self.signature = file_signature(file_path)
+        self.pending_signature = self.signature
+        self.drill_map = self.board_drill_map()
+
+    def poll(self):
+        signature = file_signature(self.file_path)
+        if signature is None or signature == self.signature:
+            return None
+
+        # The file is only read once its signature is the same on two consecutive polls,
+        # so that a file that is still being written is not parsed
+        if signature != self.pending_signature:
+            self.pending_signature = signature
+            return None
+        self.signature = signature
+
+        try:
+            changed_layers = self.parser.reload()
+        except IOError:
+            print(f"Skipping revision of {self.file_path} that could not be parsed")
+            return None
+
+        drill_map = self.board_drill_map()
+        if drill_map != self.drill_map:
+            # Holes go through every plane layer
+            self.drill_map = drill_map
+            changed_layers = changed_layers | {layer for layer, option in self.layer_to_options.items()
+                                               if option == TRACES_AND_PLANE}
+
+        self.regenerate(changed_layers)
+        return changed_layers
+
+    def board_drill_map(self):
+        """
+            Holes of the drill layers, or of all the watched layers if none is designated. The map always
+            covers the whole board, even though only the layers that changed are generated again.
+        """
+        drill_layers = [layer for layer, option in self.layer_to_options.items() if option == DRILL_ONLY]
+        return DrillMap.from_layers(self.parser.get_layer_geometry(), drill_layers or self.layer_to_options.keys())
+
+    def regenerate(self, layers=None, clean_output=False):
+        if layers is None:
+            layers = self.layer_to_options.keys()
+
+        layer_to_geometry = self.parser.get_layer_geometry()
+        selected_layer_to_geometry = {}
+        for layer in layers:
+            if self.layer_to_options.get(layer, DRILL_ONLY) == DRILL_ONLY:
+                continue
+            if layer in layer_to_geometry and layer_to_geometry[layer].count() > 0:
+                selected_layer_to_geometry[layer] = layer_to_geometry[layer]
+            elif os.path.exists(step_file_name(layer)):
+                print(f"Removing {layer.lower()}.step, the layer no longer has any geometry")
+                os.remove(step_file_name(layer))
+
+        if selected_layer_to_geometry:
+            # A revision that hangs or crashes OCC costs the layer it happened in, not the watcher
+            for report in generate_supervised(selected_layer_to_geometry, self.layer_to_options, self.step_arguments,
+                                              clean_output=clean_output, drill_map=self.drill_map):
+                if report["status"] != "done":
+                    print(f"{report['layer']} {report['status']}: {report['message']}")
+
+        return selected_layer_to_geometry.keys()
+
+    def run(self):
+        print(f"Watching {self.file_path}, press Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(self.interval)
+                changed_layers = self.poll()
+                if changed_layers is not None:
+                    print(f"Changed layers: {', '.join(sorted(changed_layers)) if changed_layers else 'none'}")
+        except KeyboardInterrupt:
+            pass
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Watch a DXF file and regenerate the STEP files of the layers "
+                                                 "that change")
+    parser.add_argument("dxf_file")
+    parser.add_argument("--traces", action="append", default=[], metavar="LAYER",
+                        help="layer to generate as conductive traces only")
+    parser.add_argument("--plane", action="append", default=[], metavar="LAYER",
+                        help="layer to generate as conductive traces, vias, and plane")
+    parser.add_argument("--drill", action="append", default=[], metavar="LAYER",
+                        help="layer whose circles are the holes of every plane (defaults to all selected layers)")
+    parser.add_argument("--width", type=float, required=True, help="width of the PCB (inches)")
+    parser.add_argument("--height", type=float, required=True, help="height of the PCB (inches)")
+    parser.add_argument("--thickness", type=float, default=0.04, help="layer thickness (inches)")
+    parser.add_argument("--trace-width", type=float, default=0.01, help="width of conductive traces (inches)")
+    parser.add_argument("--trace-thickness", type=float, default=0.01,
+                        help="thickness of conductive traces (inches)")
+    parser.add_argument("--instanced", action="store_true", help="write layers as STEP assemblies")
+    parser.add_argument("--panel", type=int, nargs=2, default=(1, 1), metavar=("ROWS", "COLUMNS"))
+    parser.add_argument("--pitch", type=float, nargs=2, default=None, metavar=("X", "Y"),
+                        help="distance between neighbouring boards of the panel (defaults to the PCB width and height)")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between checks of the file")
+    arguments = parser.parse_args(arguments)
+
+    layer_to_options = {layer: TRACES_ONLY for layer in arguments.traces}
+    layer_to_options.update({layer: TRACES_AND_PLANE for layer in arguments.plane})
+    if not layer_to_options:
+        parser.error("select at least one layer with --traces or --plane")
+    layer_to_options.update({layer: DRILL_ONLY for layer in arguments.drill})
+
+    # Same units as the GUI, which scales the trace width before passing it to GenerateSteps
+    step_arguments = {"pcb_width": arguments.width, "pcb_height": arguments.height,
+                      "layer_thickness": arguments.thickness,
+                      "conductive_trace_width": arguments.trace_width * 0.005,
+                      "conductive_trace_thickness": arguments.trace_thickness,
+                      "instanced": arguments.instanced,
+                      "panel_rows": arguments.panel[0], "panel_columns": arguments.panel[1],
+                      "panel_pitch": tuple(arguments.pitch) if arguments.pitch else None}
+
+    watcher = WatchDXF(arguments.dxf_file, layer_to_options, step_arguments, interval=arguments.interval)
+    watcher.regenerate(clean_output=True)
+    watcher.run()
+
+
+class TestWatchDXF(unittest.TestCase):
+
+    def setUp(self):
+        # STEP_files and the previews are written to the working directory
+        self.working_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.file_name = os.path.join(self.directory, 'watched.dxf')
+
+    def tearDown(self):
+        os.chdir(self.working_directory)
+        shutil.rmtree(self.directory)
+
+    def save(self, top_line_end):
+        doc = ezdxf.new()
+        doc.modelspace().add_line((0.1, 0.1), top_line_end, dxfattribs={'layer': 'TOP'})
+        doc.modelspace().add_line((0.1, 0.2), (0.9, 0.2), dxfattribs={'layer': 'BOTTOM'})
+        doc.saveas(self.file_name)
+
+    def test_only_changed_layers_are_regenerated(self):
+        self.save((0.9, 0.1))
+
+        watcher = WatchDXF(self.file_name, {'TOP': TRACES_ONLY, 'BOTTOM': TRACES_ONLY},
+                           {"pcb_width": 1, "pcb_height": 1, "layer_thickness": 0.04,
+                            "conductive_trace_width": 0.00005, "conductive_trace_thickness": 0.01})
+        self.assertEqual(set(watcher.regenerate(clean_output=True)), {'TOP', 'BOTTOM'})
+        self.assertIsNone(watcher.poll())
+
+        bottom_time = os.stat(step_file_name('BOTTOM')).st_mtime_ns
+        self.save((0.9, 0.5))
+
+        # The first poll only notices the change, the second one processes it
+        self.assertIsNone(watcher.poll())
+        self.assertEqual(watcher.poll(), {'TOP'})
+        self.assertEqual(os.stat(step_file_name('BOTTOM')).st_mtime_ns, bottom_time)
+        self.assertTrue(os.path.exists(step_file_name('TOP')))
+
+    def test_moved_hole_regenerates_planes(self):
+        def save(via_center):
+            doc = ezdxf.new()
+            doc.modelspace().add_line((0.1, 0.1), (0.9, 0.1), dxfattribs={'layer': 'TOP'})
+            doc.modelspace().add_line((0.1, 0.2), (0.9, 0.2), dxfattribs={'layer': 'BOTTOM'})
+            doc.modelspace().add_circle(via_center, 0.02, dxfattribs={'layer': 'DRILL'})
+            doc.saveas(self.file_name)
+
+        save((0.5, 0.5))
+        watcher = WatchDXF(self.file_name, {'TOP': TRACES_AND_PLANE, 'BOTTOM': TRACES_ONLY, 'DRILL': DRILL_ONLY},
+                           {"pcb_width": 1, "pcb_height": 1, "layer_thickness": 0.04,
+                            "conductive_trace_width": 0.00005, "conductive_trace_thickness": 0.01})
+        self.assertEqual(set(watcher.regenerate(clean_output=True)), {'TOP', 'BOTTOM'})
+
+        # Only the drill layer changed, but the plane of TOP is drilled by it
+        save((0.5, 0.6))
+        watcher.poll()
+        self.assertEqual(watcher.poll(), {'DRILL', 'TOP'})
+        self.assertFalse(os.path.exists(step_file_name('DRILL')))
+
+
+if __name__ == "__main__":
+    main()